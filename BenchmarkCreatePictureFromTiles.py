@@ -0,0 +1,233 @@
+from PIL import Image
+import argparse
+import os
+import os.path
+import sys
+import time
+import json
+import random
+import platform
+import tempfile
+import itertools
+import numpy as np
+import CreatePictureFromTiles as cpft
+
+#Symmetry Consts
+SYM_NONE = 'none'
+SYM_MIRROR = 'mirror'
+SYM_ROT = 'rot'
+
+#Phase Consts, in the order that they run
+PHASES = ['load', 'dedup', 'tile_build', 'grid_build', 'prune', 'fill', 'render', 'save']
+
+BENCH_VERSION = 2
+
+def ParseCommandLineArgs():
+	grid_sizes_def = '10,25,50'
+	tile_counts_def = '16,81'
+	speed_modes_def = '0,1,2,3'
+	classes_def = '0,1'
+	tile_size_def = 16
+	colors_def = 3
+	symmetry_def = SYM_NONE
+	density_def = 1.0
+	add_im_def = True
+	repeat_def = 1
+	seed_def = 0
+	out_def = 'bench.json'
+
+	prog_desc = ('Time each phase of CreatePictureFromTiles on synthetic tile sets, '
+		'across a matrix of grid sizes, tile counts, speed modes and classes settings, and write the results as json. '
+		'Tile sets are generated in a temporary directory, so no input files are needed.')
+	grid_sizes_help = ('Comma-separated widths of the square frames to create, in terms of tiles. '
+		'Default: ' + grid_sizes_def)
+	tile_counts_help = ('Comma-separated numbers of tile files to generate. '
+		'A tile set can have at most colors^4 files, as each file has a distinct combination of edge colours. '
+		'Default: ' + tile_counts_def)
+	speed_modes_help = ('Comma-separated speed modes to time. '
+		'Default: ' + speed_modes_def)
+	classes_help = ('Comma-separated settings of --classes to time: 1 to solve over classes of tiles with the same boundaries, 0 not to. '
+		'Default: ' + classes_def)
+	tile_size_help = ('Width and height of each generated tile in pixels. '
+		'Default: ' + str(tile_size_def))
+	colors_help = ('Number of distinct edge colours. Two tiles fit together when the colours of the touching edges are the same. '
+		'Default: ' + str(colors_def))
+	symmetry_help = ('Symmetry of the generated tiles. '
+		'"' + SYM_NONE + '": no symmetry. '
+		'"' + SYM_MIRROR + '": each tile is its own horizontal mirror image. '
+		'"' + SYM_ROT + '": each tile is the same under rotation, so rotated variants are all duplicates. '
+		'Default: ' + symmetry_def)
+	density_help = ('Fraction of the colours^4 edge combinations which may be picked for the tile set. '
+		'At 1.0 every combination is available (a Wang tile set in which any grid can be completed); '
+		'lower values leave a more constrained set. '
+		'Default: ' + str(density_def))
+	add_help = ('If set, rotate/mirror the generated tiles like --add does. Default: ' + str(add_im_def))
+	no_add_help = ('If set, only use the generated tiles. Default: ' + str(not add_im_def))
+	repeat_help = ('Number of times to run each combination. The fastest time of each phase is reported. '
+		'Default: ' + str(repeat_def))
+	seed_help = ('Seed for generating tile sets and for choosing tiles. '
+		'Default: ' + str(seed_def))
+	out_help = ('Name of the json file to write results to. '
+		'Default: ' + out_def)
+
+	parser = argparse.ArgumentParser(description = prog_desc)
+	parser.add_argument('--grid_sizes',  type = str,                                      help = grid_sizes_help)
+	parser.add_argument('--tile_counts', type = str,                                      help = tile_counts_help)
+	parser.add_argument('--speed_modes', type = str,                                      help = speed_modes_help)
+	parser.add_argument('--classes',     type = str,                                      help = classes_help)
+	parser.add_argument('--tile_size',   type = int,                                      help = tile_size_help)
+	parser.add_argument('--colors',      type = int,                                      help = colors_help)
+	parser.add_argument('--symmetry',    type = str, choices = [SYM_NONE, SYM_MIRROR, SYM_ROT], help = symmetry_help)
+	parser.add_argument('--density',     type = float,                                    help = density_help)
+	parser.add_argument('--add',         dest = 'add_im', action = 'store_true',          help = add_help)
+	parser.add_argument('--no_add',      dest = 'add_im', action = 'store_false',         help = no_add_help)
+	parser.add_argument('--repeat',      type = int,                                      help = repeat_help)
+	parser.add_argument('--seed',        type = int,                                      help = seed_help)
+	parser.add_argument('--out',   '-o', type = str,                                      help = out_help)
+
+	parser.set_defaults(grid_sizes = grid_sizes_def, tile_counts = tile_counts_def, speed_modes = speed_modes_def, classes = classes_def,
+		tile_size = tile_size_def, colors = colors_def, symmetry = symmetry_def, density = density_def,
+		add_im = add_im_def, repeat = repeat_def, seed = seed_def, out = out_def)
+
+	args = parser.parse_args()
+
+	return args
+
+def GetIntList(list_str):
+	return [int(x) for x in list_str.split(',') if x.strip() != '']
+
+def CreateSyntheticTileSet(path, tile_size, colors, symmetry, density, tile_count, seed):
+	#Write tile_count tiles to path, each with its own combination of (TOP, RIGHT, BOT, LEFT) edge colours.
+	#Edges are a single colour apart from the corners, which are black, so that edges of the same colour always match.
+	#Returns the number of tiles actually written.
+	rng = random.Random(seed)
+	palette = [(rng.randrange(256), rng.randrange(256), rng.randrange(256)) for c in range(colors)]
+
+	combos = list(itertools.product(range(colors), repeat = 4))
+	if symmetry == SYM_MIRROR:
+		combos = [combo for combo in combos if combo[cpft.LEFT] == combo[cpft.RIGHT]]
+	elif symmetry == SYM_ROT:
+		combos = [combo for combo in combos if len(set(combo)) == 1]
+
+	combos = [combo for combo in combos if rng.random() < density]
+	rng.shuffle(combos)
+	combos = combos[:tile_count]
+
+	np_rng = np.random.default_rng(seed)
+	for (k, combo) in enumerate(combos):
+		pixels = np_rng.integers(0, 256, (tile_size, tile_size, 3), dtype = np.uint8)
+
+		#Make the interior as symmetric as the edges, or the variants will never be duplicates
+		if symmetry == SYM_MIRROR:
+			pixels[:, tile_size - tile_size // 2:] = pixels[:, :tile_size // 2][:, ::-1]
+		elif symmetry == SYM_ROT:
+			for rot in range(1, 4):
+				pixels = np.maximum(pixels, np.rot90(pixels, rot))
+
+		pixels[0] = palette[combo[cpft.TOP]]
+		pixels[:, -1] = palette[combo[cpft.RIGHT]]
+		pixels[-1] = palette[combo[cpft.BOT]]
+		pixels[:, 0] = palette[combo[cpft.LEFT]]
+		for (y, x) in [(0, 0), (0, -1), (-1, 0), (-1, -1)]:
+			pixels[y, x] = (0, 0, 0)
+
+		Image.fromarray(pixels, 'RGB').save(os.path.join(path, 'tile' + str(k).zfill(4) + '.png'))
+
+	return len(combos)
+
+def TimePhase(timings, phase, func, *args):
+	start = time.perf_counter()
+	result = func(*args)
+	timings[phase] = time.perf_counter() - start
+	return result
+
+def DeleteAllDuplicates(file_list, variants):
+	#The duplicate checks of GetImagesFromPath: those between the variants of each file, then those between every file
+	for (pixels, transforms, all_edges) in file_list:
+		cpft.GetDistinctTransforms(pixels, transforms, all_edges)
+	return cpft.DeleteDuplicateImages(variants)
+
+def RunBenchmark(path, out_path, add_im, grid_size, speed_mode, classes, seed):
+	#Run every phase once, and return the time taken by each one in seconds.
+	#Phases that don't apply to speed_mode are reported as None.
+	timings = dict.fromkeys(PHASES)
+	solve_args = cpft.ParseCommandLineArgs(['--classes' if classes else '--no_classes'])
+
+	with cpft.UseContext(cpft.RunContext(rng = random.Random(seed), verbose = False)):
+		im_list = TimePhase(timings, 'load', cpft.GetImagesFromPath, path, add_im)
+
+		#Loading already removes duplicates, so time it separately on what loading checks for duplicates
+		if add_im:
+			file_list = []
+			variants = []
+			for file in sorted(os.listdir(path)):
+				file = os.path.join(path, file)
+				(err, file_hash, size, pixel_data, variant_data) = cpft.LoadImageVariants(file, add_im)
+				pixels = np.frombuffer(pixel_data, dtype = np.uint8).reshape(size[1], size[0], cpft.TILE_CHANNELS)
+				transforms = cpft.GetTransforms(size, add_im)
+				file_list.append((pixels, transforms, [cpft.TransformEdges(cpft.GetImageEdges(pixels), transform) for transform in transforms]))
+
+				#The variants are made as GetImagesFromPath makes them, before it removes the duplicates among them
+				base = Image.frombytes(cpft.TILE_MODE, size, pixel_data)
+				variants += [cpft.LazyTileImage(file, size, transform, edges, digest, base) for (transform, edges, digest) in variant_data]
+			TimePhase(timings, 'dedup', DeleteAllDuplicates, file_list, variants)
+			cpft.CloseImages(variants)
+
+		tile_map = TimePhase(timings, 'tile_build', cpft.GetTilesFromImages, im_list)
+		bound_index = cpft.GetBoundaryIndex(tile_map)
+		tile_grid = TimePhase(timings, 'grid_build', cpft.ConstructTileGrid, tile_map, grid_size, grid_size)
+
+		if speed_mode in [cpft.NORMAL, cpft.BACKTRACK]:
+			tile_grid = TimePhase(timings, 'prune', cpft.PruneTileGrid, tile_grid, tile_map, bound_index, grid_size, grid_size)
+
+		#Speed mode 0 prunes the grid again itself, but as the grid is already pruned that pass finds nothing to remove
+		tile_grid = TimePhase(timings, 'fill', cpft.ProcessTileGridWithClasses,
+			tile_grid, tile_map, bound_index, grid_size, grid_size, speed_mode, solve_args)
+		black_tiles = sum(row.count([]) for row in tile_grid)
+
+		new_im = TimePhase(timings, 'render', cpft.CreatePictureFromTileGrid, tile_grid, tile_map, grid_size, grid_size)
+		if new_im != None:
+			TimePhase(timings, 'save', new_im.save, out_path)
+			new_im.close()
+		cpft.CloseImages(im_list)
+
+	return (timings, len(tile_map), black_tiles)
+
+def Main():
+	args = ParseCommandLineArgs()
+
+	results = []
+	with tempfile.TemporaryDirectory() as tmp_dir:
+		out_path = os.path.join(tmp_dir, 'out.png')
+
+		for tile_count in GetIntList(args.tile_counts):
+			tile_path = os.path.join(tmp_dir, 'tiles' + str(tile_count))
+			os.mkdir(tile_path)
+			file_count = CreateSyntheticTileSet(tile_path, args.tile_size, args.colors, args.symmetry, args.density, tile_count, args.seed)
+
+			for (grid_size, speed_mode, classes) in itertools.product(GetIntList(args.grid_sizes), GetIntList(args.speed_modes), GetIntList(args.classes)):
+				print('Tiles: ' + str(file_count) + ', grid: ' + str(grid_size) + 'x' + str(grid_size) + ', speed mode: ' + str(speed_mode) +
+					', classes: ' + str(classes))
+				sys.stdout.flush()
+
+				best = dict.fromkeys(PHASES)
+				for k in range(args.repeat):
+					(timings, variant_count, black_tiles) = RunBenchmark(tile_path, out_path, args.add_im, grid_size, speed_mode, classes != 0, args.seed + k)
+					for phase in PHASES:
+						if timings[phase] != None and (best[phase] == None or timings[phase] < best[phase]):
+							best[phase] = timings[phase]
+
+				results.append({'tile_files':file_count, 'tiles':variant_count, 'tile_size':args.tile_size,
+					'colors':args.colors, 'symmetry':args.symmetry, 'density':args.density, 'add_im':args.add_im,
+					'grid_size':grid_size, 'speed_mode':speed_mode, 'classes':classes != 0, 'black_tiles':black_tiles, 'seconds':best})
+
+	report = {'version':BENCH_VERSION, 'created':time.strftime('%Y-%m-%dT%H:%M:%S'),
+		'python':platform.python_version(), 'platform':platform.platform(), 'cpus':os.cpu_count(),
+		'seed':args.seed, 'repeat':args.repeat, 'results':results}
+	with open(args.out, 'w') as f:
+		json.dump(report, f, indent = 1)
+
+	print('Results written to ' + args.out)
+
+if __name__ == "__main__":
+	Main()
@@ -1,4 +1,4 @@
-from PIL import Image, ImageOps, ImageChops
+from PIL import Image, ImageOps
 import argparse
 import os
 import os.path
@@ -7,7 +7,24 @@ import glob
 import random
 import re
 import yaml
-from copy import deepcopy
+import hashlib
+import io
+import json
+import zlib
+import csv
+import numpy as np
+import itertools
+import functools
+import concurrent.futures
+from collections import deque, OrderedDict
+import heapq
+import contextlib
+import contextvars
+import threading
+import queue
+import time
+import tracemalloc
+import cProfile
 
 #Log Consts
 LOG_NAME = 'CreatePictureFromTiles_LOG.txt'
@@ -19,6 +36,9 @@ TOP = 0
 RIGHT = 1
 BOT = 2
 LEFT = 3
+DIRS = [TOP, RIGHT, BOT, LEFT]
+OPP = {TOP:BOT, RIGHT:LEFT, BOT:TOP, LEFT:RIGHT}
+DIR_OFFSET = {TOP:(0,-1), RIGHT:(1,0), BOT:(0,1), LEFT:(-1,0)} #(x,y) offset to the neighbour in each direction
 
 #For 2-tuples
 X = 0
@@ -33,25 +53,71 @@ YUV_V = 2
 NORMAL = 0
 FAST = 1
 NO_COMPARE = 2
+BACKTRACK = 3
+BACKTRACK_MEMO_SIZE = 1 << 16 #Number of neighbour lookups that speed mode 3 remembers before it starts over
+MIN_STRIP_ROWS = 4 #Fewest rows that each strip of --strips gets, counting its seam row
+
+#Profile Consts
+PROFILE_PHASES = ['load', 'dedup', 'tile_build', 'grid_build', 'process', 'prune', 'render', 'save']
+
+#Tile Image Consts
+TILE_MODE = 'YCbCr' #Makes operations such as deblocking work.
+TILE_CHANNELS = 3
+
+#Tile Cache Consts
+CACHE_NAME = '.CreatePictureFromTiles_cache'
+CACHE_MAGIC = b'CPFT_TILE_CACHE\n'
+CACHE_VERSION = 2
+CACHE_ALIGN = 64
+
+#Grid File Consts
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader) #The C loader is much faster, but PyYAML may be built without it
+
+#Solved Grid Consts
+GRID_EXT = '.grid'
+GRID_MAGIC = b'CPFT_SOLVED_GRID\n'
+GRID_VERSION = 1
+ERR_TILE = -1 #Tile id that a solved grid array holds for erroneous (black) grid spaces
+
+#Tile Set Cache Consts
+TILE_SET_CACHE_SIZE = 4 #Number of loaded tile sets that GetTileSet keeps around
+
+#Deep Zoom Consts
+DZI_EXT = '.dzi'
+DZI_TILE_SIZE = 256 #Width and height of each pyramid tile. Must be even, so that halving a tile's children lines up with halving the level.
+DZI_FORMAT = 'png' #Lossless, so that the levels made from the level above read back exactly what was written
+
+#Preview Consts
+PREVIEW_ATLAS_CACHE_SIZE = 8 #Number of scaled down tile atlases that GetPreviewAtlas keeps around
+
+#Pipeline Consts
+PIPELINE_QUEUE_ROWS = 16 #Number of solved rows of tiles that may wait to be rendered before the solver waits too
 
 #Global Vars
-g_do_log = False
-g_log_file = None
-g_err_occurred = False
+g_context = contextvars.ContextVar('g_context', default = None) #The RunContext of the current call
+g_worker_tile_set = None #The tile set of a worker process, given to it once by SetupWorker
+g_tile_set_cache = OrderedDict()
+g_tile_set_cache_lock = threading.Lock()
+g_preview_atlases = OrderedDict()
+g_preview_atlases_lock = threading.Lock()
 
 class Tile:
-	def __init__(self, im):
+	def __init__(self, im, edge_ids):
 		self.im = im
-		self.boundaries = {}
+		self.filename = im.filename
+		self.transform = im.tile_transform
 		
-		#Get pixel data, a list of rows, with each row containing pixel data
-		width, height = im.size
-		pixels = [list(im.getdata())[i * width:(i + 1) * width] for i in range(height)]
+		#Edges keep their exact bytes, so that boundaries only match when the pixels do.
+		#Images loaded from the tile cache come with their edges already.
+		if hasattr(im, 'edges'):
+			self.edges = im.edges
+		else:
+			self.edges = GetImageEdges(np.asarray(im))
 		
-		self.boundaries[TOP] = hash(tuple((pixels[0])))
-		self.boundaries[RIGHT] = hash(tuple([row[width - 1] for row in pixels]))
-		self.boundaries[BOT] = hash(tuple(pixels[height - 1]))
-		self.boundaries[LEFT] = hash(tuple([row[0] for row in pixels]))
+		#edge_ids is shared by every tile in the set, and gives each distinct edge its own integer id
+		self.boundaries = {}
+		for dir in DIRS:
+			self.boundaries[dir] = edge_ids.setdefault(self.edges[dir], len(edge_ids))
 		
 	def CompareBoundaries(self, dir, boundaries):
 		if boundaries == []:
@@ -61,7 +127,342 @@ class Tile:
 		else:
 			return self.boundaries[dir] in boundaries
 
-def ParseCommandLineArgs():
+class TileClass:
+	#Stands in for every tile with the same four boundaries while solving, as those tiles fit in all the same places.
+	#Which of them goes in a grid space is only picked once the grid has been solved.
+	def __init__(self, tile_ids, tile_map):
+		self.tile_ids = tile_ids
+		self.boundaries = tile_map[tile_ids[0]].boundaries
+		self.weight = len(tile_ids)
+
+class LazyTileImage:
+	#A tile variant: the image of a tile file, turned by a (degree, mirrored) transform. The variant's size, edges and
+	#digest are known up front, but its pixels are only transformed when they are needed, such as for rendering.
+	#base is the image of the tile file, which all of the file's variants share. In low memory mode there is no base,
+	#and the tile file is decoded again whenever the pixels are needed.
+	def __init__(self, filename, size, transform, edges, digest, base = None):
+		self.filename = filename
+		self.size = size
+		self.mode = TILE_MODE
+		self.tile_transform = transform
+		self.edges = edges
+		self.digest = digest
+		self.base = base
+	
+	def GetBase(self, decoded = None):
+		#Returns the image of the tile file, or None on error. decoded maps file names to decoded tile files,
+		#so that a file with several variants in use is only decoded once.
+		if self.base != None:
+			return self.base
+		
+		if decoded == None:
+			decoded = {}
+		if self.filename not in decoded:
+			try:
+				with Image.open(self.filename) as im:
+					decoded[self.filename] = im.convert(TILE_MODE)
+			except OSError as err:
+				Log(ERR, 'Failed to load tile from ' + self.filename + '. Using a black tile in its place. Error message: "' + str(err) + '"')
+				decoded[self.filename] = None
+		return decoded[self.filename]
+	
+	def Load(self, decoded = None):
+		#Returns the variant as an image, or None on error
+		base = self.GetBase(decoded)
+		if base == None:
+			return None
+		
+		new_im = base if self.tile_transform == (0, False) else TransformImage(base, self.tile_transform)
+		if self.base == None and GetImageDigest(new_im) != self.digest:
+			Log(ERR, 'Tile file ' + self.filename + ' has changed since it was loaded')
+		return new_im
+	
+	def tobytes(self):
+		new_im = self.Load()
+		if new_im == None:
+			return bytes(self.size[0] * self.size[1] * TILE_CHANNELS)
+		return new_im.tobytes()
+	
+	def close(self):
+		pass
+
+class TileCache:
+	#On-disk cache of the variants that GetImagesFromPath creates from each tile file. The file consists of
+	#CACHE_MAGIC, the length of a json header, the header, then two contiguous uint8 arrays which can be memory-mapped:
+	#the decoded pixel data of every file, with shape (files, height, width, channels),
+	#and the TOP, RIGHT, BOT and LEFT edges of every variant back to back, with shape (variants, edge bytes).
+	#The header maps each file's absolute path to its size, mtime, content hash and index in the pixel data,
+	#and to the transforms, digests and edge indices of the variants that came from it.
+	def __init__(self, cache_path, add_im):
+		self.cache_path = cache_path
+		self.add_im = add_im
+		self.entries = {}
+		self.new_entries = {}
+		self.pixels = None
+		self.edges = None
+		self.is_dirty = False
+		
+		if os.path.isfile(cache_path):
+			try:
+				self.Load()
+			except (OSError, ValueError, KeyError) as err:
+				Log(WARN, 'Ignoring unreadable tile cache "' + cache_path + '". Error message: "' + str(err) + '"')
+				self.entries = {}
+		
+	def Load(self):
+		with open(self.cache_path, 'rb') as f:
+			if f.read(len(CACHE_MAGIC)) != CACHE_MAGIC:
+				raise ValueError('not a tile cache')
+			header_len = int.from_bytes(f.read(8), 'little')
+			header = json.loads(f.read(header_len).decode())
+		
+		if header['version'] != CACHE_VERSION or header['add_im'] != self.add_im or header['variant_count'] == 0:
+			#Variants differ with add_im, so a cache made with a different setting is of no use
+			return
+		
+		(width, height) = header['size']
+		edge_len = 2 * (width + height) * TILE_CHANNELS
+		offset = len(CACHE_MAGIC) + 8 + header_len
+		self.pixels = np.memmap(self.cache_path, dtype = np.uint8, mode = 'r', offset = offset,
+			shape = (header['file_count'], height, width, TILE_CHANNELS))
+		self.edges = np.memmap(self.cache_path, dtype = np.uint8, mode = 'r', offset = offset + self.pixels.nbytes,
+			shape = (header['variant_count'], edge_len))
+		self.size = (width, height)
+		self.entries = header['files']
+	
+	def GetVariants(self, file, low_memory = False):
+		#Returns the cached variants of file, or None if file is not cached or has changed since.
+		#In low memory mode, the variants don't keep the file's pixels. They decode the tile file again when they are needed.
+		entry = self.entries.get(os.path.abspath(file))
+		if entry == None:
+			return None
+		
+		stat = os.stat(file)
+		if entry['size'] != stat.st_size:
+			return None
+		elif entry['mtime_ns'] != stat.st_mtime_ns:
+			#The file was touched, but its contents may be the same
+			with open(file, 'rb') as f:
+				if GetFileHash(f.read()) != entry['hash']:
+					return None
+			entry['mtime_ns'] = stat.st_mtime_ns
+			self.is_dirty = True
+		
+		(width, height) = self.size
+		base = None
+		if not low_memory:
+			base = Image.frombytes(TILE_MODE, self.size, self.pixels[entry['pixel_index']].tobytes())
+		
+		variants = []
+		for variant in entry['variants']:
+			k = variant['index']
+			edges = {
+				TOP: self.edges[k, 0:width * TILE_CHANNELS].tobytes(),
+				RIGHT: self.edges[k, width * TILE_CHANNELS:(width + height) * TILE_CHANNELS].tobytes(),
+				BOT: self.edges[k, (width + height) * TILE_CHANNELS:(2 * width + height) * TILE_CHANNELS].tobytes(),
+				LEFT: self.edges[k, (2 * width + height) * TILE_CHANNELS:].tobytes()}
+			variants.append(LazyTileImage(file, self.size, tuple(variant['transform']), edges, bytes.fromhex(variant['digest']), base))
+		
+		#The pixels are kept as a view of the cache file, so that saving the cache again doesn't decode the file
+		self.new_entries[os.path.abspath(file)] = (entry, variants, self.pixels[entry['pixel_index']])
+		return variants
+	
+	def AddVariants(self, file, file_hash, variants, pixel_data = None):
+		#pixel_data is the raw pixel data of the file's image, if the variants don't keep it
+		stat = os.stat(file)
+		entry = {'size':stat.st_size, 'mtime_ns':stat.st_mtime_ns, 'hash':file_hash}
+		self.new_entries[os.path.abspath(file)] = (entry, variants, pixel_data)
+		self.is_dirty = True
+	
+	def Save(self):
+		#Entries of files which weren't seen in this run belong to deleted files, and are dropped
+		if not self.is_dirty and self.new_entries.keys() == self.entries.keys():
+			return
+		
+		#All tiles must be of the same size, so entries that differ from the first can't be stored alongside it
+		all_variants = [im for (entry, variants, pixels) in self.new_entries.values() for im in variants]
+		size = all_variants[0].size if all_variants != [] else (0, 0)
+		
+		files = {}
+		base_list = []
+		tile_list = []
+		for (file, (entry, variants, pixels)) in self.new_entries.items():
+			if variants == [] or variants[0].size != size or variants[0].mode != TILE_MODE:
+				continue
+			
+			entry['pixel_index'] = len(base_list)
+			base_list.append((variants[0], pixels))
+			entry['variants'] = []
+			for im in variants:
+				entry['variants'].append({'index':len(tile_list), 'transform':list(im.tile_transform), 'digest':GetImageDigest(im).hex()})
+				tile_list.append(im)
+			files[file] = entry
+		
+		header = {'version':CACHE_VERSION, 'add_im':self.add_im, 'size':list(size), 'file_count':len(base_list),
+			'variant_count':len(tile_list), 'files':files}
+		header_data = json.dumps(header).encode()
+		#Pad the header so that the arrays start on an aligned offset
+		header_data += b' ' * (-(len(CACHE_MAGIC) + 8 + len(header_data)) % CACHE_ALIGN)
+		
+		#Write to a temporary file first, so that an interrupted run doesn't leave a broken cache behind
+		tmp_path = self.cache_path + '.tmp'
+		try:
+			with open(tmp_path, 'wb') as f:
+				f.write(CACHE_MAGIC)
+				f.write(len(header_data).to_bytes(8, 'little'))
+				f.write(header_data)
+				for (im, pixels) in base_list:
+					if isinstance(pixels, np.ndarray):
+						f.write(pixels.tobytes())
+					elif pixels != None:
+						f.write(pixels)
+					else:
+						base = im.GetBase()
+						f.write(base.tobytes() if base != None else bytes(size[0] * size[1] * TILE_CHANNELS))
+				for im in tile_list:
+					for dir in DIRS:
+						f.write(im.edges[dir])
+			os.replace(tmp_path, self.cache_path)
+		except OSError as err:
+			Log(WARN, 'Failed to write tile cache "' + self.cache_path + '". Error message: "' + str(err) + '"')
+
+class TileSet:
+	#The tiles of one directory, loaded once so that any number of pictures can be generated from them.
+	#Use GetTileSet to share tile sets between calls instead of loading the same directory again.
+	#Loads in a quiet context of its own unless one is given, which the caller can check err_occurred of afterwards.
+	def __init__(self, path, add_im = True, cache_path = None, jobs = 1, low_memory = False, context = None):
+		self.path = path
+		self.add_im = add_im
+		if context == None:
+			context = RunContext(verbose = False)
+		
+		with UseContext(context):
+			with ProfilePhase('load'):
+				self.im_list = GetImagesFromPath(path, add_im, cache_path, jobs, low_memory)
+			with ProfilePhase('tile_build'):
+				self.tile_map = GetTilesFromImages(self.im_list)
+				self.bound_index = GetBoundaryIndex(self.tile_map)
+	
+	def Generate(self, size = None, grid = '', speed_mode = NORMAL, seed = None, return_grid = False,
+		strips = 1, backtrack_budget = 10000, jobs = 1, classes = True, context = None, preview = None):
+		#Create a picture which is size tiles wide and high, or which follows the grid yaml file grid in the tile directory.
+		#size is a (width, height) tuple or a string like the one --size takes.
+		#If preview is given, the picture is scaled down by it, like --preview does.
+		#Returns the picture as an RGB image, or None on error. If return_grid is set, returns the processed tile grid instead,
+		#in which each grid space holds a key of tile_map, or [] where no tile fit.
+		#Runs in a context of its own unless one is given, so that calls from several threads don't share random state,
+		#and so that the caller can check context.err_occurred afterwards.
+		if context == None:
+			context = RunContext(rng = random.Random(seed), verbose = False)
+		
+		args = ParseCommandLineArgs([])
+		args.path = self.path
+		args.strips = strips
+		args.backtrack_budget = backtrack_budget
+		args.classes = classes
+		
+		if size != None and type(size) != str:
+			size = ','.join(str(x) for x in size)
+		job = {'size':size if size != None else args.size, 'grid':grid, 'speed_mode':speed_mode, 'seed':seed}
+		
+		with UseContext(context):
+			(tile_grid, frame_width, frame_height) = SolveTileGrid(job, self.tile_map, self.bound_index, args, jobs, verbose = False)
+			if return_grid:
+				return tile_grid
+			
+			with ProfilePhase('render'):
+				return CreatePictureFromTileGrid(tile_grid, self.tile_map, frame_width, frame_height, self.GetAtlas(preview))
+	
+	def Reroll(self, tile_grid, region, image = None, grid = '', speed_mode = NORMAL, seed = None,
+		backtrack_budget = 10000, context = None):
+		#Choose new tiles for region, an (x, y, width, height) rectangle of a tile grid returned by Generate,
+		#while the tiles around the region stay in place. tile_grid is updated in place.
+		#The new tiles are chosen from the ones that the grid yaml file grid allows, such as an edited copy of the
+		#file that tile_grid was created from, or from every tile if there is no grid.
+		#If image, the picture previously created from tile_grid, is given, only the region is painted over in it.
+		#Returns the region clipped to the frame, or None on error.
+		if context == None:
+			context = RunContext(rng = random.Random(seed), verbose = False)
+		
+		(frame_width, frame_height) = (len(tile_grid[0]) if tile_grid != [] else 0, len(tile_grid))
+		
+		with UseContext(context):
+			cand_grid = None
+			if grid != '':
+				(cand_grid, grid_width, grid_height) = GetTileGridFromFile(os.path.join(self.path, grid), self.tile_map)
+				if cand_grid == []:
+					return None
+				elif (grid_width, grid_height) != (frame_width, frame_height):
+					Log(ERR, 'Grid "' + grid + '" is ' + str(grid_width) + 'x' + str(grid_height) + ' tiles, '
+						'but the tile grid to reroll is ' + str(frame_width) + 'x' + str(frame_height))
+					return None
+			
+			region = ResolveTileGridRegion(tile_grid, cand_grid, self.tile_map, self.bound_index, frame_width, frame_height,
+				region, speed_mode, backtrack_budget)
+			
+			if region != None and image != None:
+				with ProfilePhase('render'):
+					RepaintTileGridRegion(image, tile_grid, self.tile_map, region)
+		
+		return region
+	
+	def Replay(self, grid_path, context = None, preview = None):
+		#Create the picture of a solved tile grid saved by SaveSolvedGrid, without solving anything.
+		#Returns the picture as an RGB image, or None on error. preview scales it down like Generate's does.
+		if context == None:
+			context = RunContext(verbose = False)
+		
+		with UseContext(context):
+			(tile_grid, frame_width, frame_height) = LoadSolvedGrid(grid_path, self.tile_map)
+			with ProfilePhase('render'):
+				return CreatePictureFromTileGrid(tile_grid, self.tile_map, frame_width, frame_height, self.GetAtlas(preview))
+	
+	def GetAtlas(self, preview = None):
+		if preview == None or self.tile_map == {}:
+			return None
+		elif preview <= 0:
+			Log(ERR, 'Preview scale must be greater than 0, but is ' + str(preview) + '. Creating the picture at full size instead')
+			return None
+		return GetPreviewAtlas(self.tile_map, preview)
+	
+	def Close(self):
+		CloseImages(self.im_list)
+
+def GetTileSet(path, add_im = True, cache_path = None, jobs = 1, low_memory = False, context = None):
+	#Returns the TileSet of path, which is only loaded if it isn't one of the TILE_SET_CACHE_SIZE most recently used.
+	#context is the one to load it in, as for TileSet.
+	#Tile sets are loaded again when files were added to or removed from their directory since,
+	#but not when a file was changed in place. Call ClearTileSetCache in that case.
+	key = (os.path.abspath(path), add_im, os.path.abspath(cache_path) if cache_path != None else None, low_memory)
+	mtime_ns = os.stat(path).st_mtime_ns if os.path.isdir(path) else None
+	
+	with g_tile_set_cache_lock:
+		entry = g_tile_set_cache.get(key)
+		if entry != None and entry[0] == mtime_ns:
+			g_tile_set_cache.move_to_end(key)
+			return entry[1]
+	
+	#Load without holding the lock, so that other directories can be fetched meanwhile
+	tile_set = TileSet(path, add_im, cache_path, jobs, low_memory, context)
+	if tile_set.tile_map == {}:
+		return tile_set
+	
+	#Evicted tile sets aren't closed, as a caller may still be using them
+	with g_tile_set_cache_lock:
+		g_tile_set_cache[key] = (mtime_ns, tile_set)
+		g_tile_set_cache.move_to_end(key)
+		while len(g_tile_set_cache) > TILE_SET_CACHE_SIZE:
+			g_tile_set_cache.popitem(last = False)
+	
+	return tile_set
+
+def ClearTileSetCache():
+	with g_tile_set_cache_lock:
+		g_tile_set_cache.clear()
+	with g_preview_atlases_lock:
+		g_preview_atlases.clear()
+
+def ParseCommandLineArgs(argv = None):
 	size_def = '(0,0)'
 	grid_def = ''
 	path_def = './'
@@ -69,26 +470,49 @@ def ParseCommandLineArgs():
 	speed_mode_def = 0
 	add_im_def = True
 	log_def = False
+	cache_def = None
+	jobs_def = 1
+	stream_def = False
+	backtrack_budget_def = 10000
+	seed_def = None
+	count_def = 1
+	manifest_def = ''
+	strips_def = 1
+	profile_def = False
+	profile_phase_def = ''
+	profile_memory_def = False
+	save_grid_def = False
+	replay_def = ''
+	low_memory_def = False
+	classes_def = True
+	pipeline_def = False
+	preview_def = None
 	
 	prog_desc = ('Given a path to a directory of tile images ' 
 		'(which have the same size and can be linked without mismatching borders), ' 
 		'as well as a frame width and height in terms of tiles OR a pre-made grid yaml file, ' 
-		'generate a picture. REQUIRES PYTHON 3 AND PILLOW')
+		'generate a picture. REQUIRES PYTHON 3, PILLOW AND NUMPY')
 	size_help = ('The width and height (comma-separated) of the frame in terms of tiles. '
 		'Example formats: "1,2", "(1,2)". ')
 	grid_help = ('filename of the grid.yaml file which contains a pre-made tile grid. '
+		'Its grid may also be kept in a CSV or .npy file, named by the yaml file in place of the rows of grid ids. '
 		'If this argument is given, file size is ignored. '
 		'Default: no grid file provided. ')
 	path_help = ('Path to a directory that only contains tiles, '
 		'Default: ' + path_def)
 	out_help = ('Name of the image file to output. '
 		'The name should include the extension, which dictates the image format of the output. '
+		'With a "' + DZI_EXT + '" extension, the picture is saved as a Deep Zoom pyramid instead: the ' + DZI_EXT + ' file describes it, '
+		'and its tiles go in a "_files" directory next to it. '
 		'Default: ' + out_def)
 	speed_help = ('0: Puts tiles together slowly in an attempt to mitigate misplacements. '
 		'Use this when you have a complex set of tiles wherein not every combination will fit together. '
 		'1: Puts tiles together quickly while also trying to make sure that they fit together. '
 		'Use this when you know that a tile can fit in any given space and the boundaries have to match. '
 		'2: Puts tiles together without caring about whether or not the boundaries match. '
+		'3: Puts tiles together by always filling the grid space with the fewest options next, '
+		'and going back on earlier choices when a grid space is left without options. '
+		'Use this when you have a complex set of tiles and the other modes leave black regions. '
 		'Default: ' + str(speed_mode_def))
 	add_help = ('If set, will try to create new images by rotating/mirroring provided ones. '
 		'Use this if you have few images which exclude basic rotation possibilities. '
@@ -100,6 +524,72 @@ def ParseCommandLineArgs():
 		'If not set, only report errors to stdout. '
 		'Default: ' + str(log_def))
 	no_log_help = ('If set, disable logging. Default: ' + str(not log_def))
+	cache_help = ('Path of a file in which to cache the decoded, rotated and mirrored tiles between runs. '
+		'Only tiles whose files were added or changed since the last run get decoded again. '
+		'If given without a path, the cache is kept in the tile directory as "' + CACHE_NAME + '". '
+		'Default: no cache. ')
+	stream_help = ('If set, render and encode the picture one row of tiles at a time instead of all at once, '
+		'so that memory use stays at about one row of tiles. '
+		'The extension of the output must be one of: ' + ', '.join(STREAM_FORMATS) + '. '
+		'Default: ' + str(stream_def))
+	backtrack_help = ('Maximum number of choices that speed mode 3 may go back on before giving up, '
+		'in which case undecided grid spaces are left black. '
+		'Default: ' + str(backtrack_budget_def))
+	seed_help = ('Seed for the random choice of tiles, so that a picture can be created again. '
+		'When creating several pictures, the nth picture uses seed + n. '
+		'Default: a different seed every run. ')
+	count_help = ('Number of pictures to create from the same tiles, which are only loaded once. '
+		'The pictures are numbered by replacing "{}" in the name given by out, '
+		'or by adding "_n" before the extension if out has no "{}". '
+		'Default: ' + str(count_def))
+	manifest_help = ('filename of a yaml file listing pictures to create from the same tiles, which are only loaded once. '
+		'Each entry needs an "out" name and may set "size", "grid", "speed_mode" and "seed", '
+		'which otherwise come from the command line. An entry which sets "size" but not "grid" ignores --grid. '
+		'Default: no manifest provided. ')
+	strips_help = ('Number of horizontal strips to split the frame into, which are processed in parallel by the processes given by jobs. '
+		'The rows in between strips are processed first, from the top down, and each strip has to fit against them. '
+		'Each strip gets at least ' + str(MIN_STRIP_ROWS) + ' rows, so a short frame gets fewer strips. '
+		'Use this for very large frames. '
+		'Default: ' + str(strips_def))
+	profile_help = ('If set, record the time taken by each phase, along with counts of the work done, '
+		'and write them to a json file named after the output with ".profile.json" added. '
+		'Only work done in this process is recorded, not work done by other processes given by jobs. '
+		'Default: ' + str(profile_def))
+	profile_memory_help = ('If set along with --profile, also trace the peak memory of each phase. '
+		'Tracing slows the run down, so time and memory are best measured in separate runs. '
+		'Memory allocated by PIL, such as for decoding tiles, is not traced. '
+		'Default: ' + str(profile_memory_def))
+	profile_phase_help = ('Along with --profile, also record cProfile stats of this phase to a ".prof" file next to the profile. '
+		'One of: ' + ', '.join(PROFILE_PHASES) + '. '
+		'Default: no cProfile stats. ')
+	save_grid_help = ('If set, also save the solved tile grid to a file named after the output with "' + GRID_EXT + '" added, '
+		'which --replay can create the picture from again without solving. '
+		'Default: ' + str(save_grid_def))
+	replay_help = ('filename of a solved tile grid saved by --save_grid. The picture is created from it straight away, '
+		'using the tiles in path, instead of solving a new tile grid. '
+		'Default: no solved tile grid provided. ')
+	low_memory_help = ('If set, only keep the edges of the tiles in memory while solving, instead of their pixels. '
+		'The tiles that end up in the picture are decoded from their files again when it is created. '
+		'Use this for large sets of tiles. '
+		'Default: ' + str(low_memory_def))
+	classes_help = ('If set, solve over classes of tiles which have the same four boundaries and are allowed in the same grid spaces, '
+		'and only pick a tile of each class once the picture has been solved. '
+		'Every tile is still as likely to be picked. '
+		'Default: ' + str(classes_def))
+	no_classes_help = ('If set, solve over the individual tiles, as pictures made before classes were added were. '
+		'Default: ' + str(not classes_def))
+	pipeline_help = ('If set, render and encode each row of tiles on another thread as soon as it has been solved, '
+		'so that solving and encoding the picture overlap. Like --stream, memory use stays low, '
+		'and the extension of the output must be one of: ' + ', '.join(STREAM_FORMATS) + '. '
+		'Speed mode 3 and --strips only hand their rows over once the whole frame has been solved. '
+		'Default: ' + str(pipeline_def))
+	preview_help = ('If given, create a preview of the picture scaled by SCALE instead, such as 0.25 for a quarter of the width and height. '
+		'Tiles are solved at full size as usual, but each tile is only scaled down once, and the picture is created from the small tiles. '
+		'Use it along with --cache, so that tiles are not decoded again every run, to quickly try out grid files. '
+		'Default: no preview. ')
+	jobs_help = ('Number of processes to decode tile images and create pictures with, and of threads to save Deep Zoom pyramids with. '
+		'0 uses one per core. '
+		'Default: ' + str(jobs_def))
 	
 	parser = argparse.ArgumentParser(description = prog_desc)
 	parser.add_argument('--size',       '-s', type = str,                                  help = size_help)
@@ -111,59 +601,616 @@ def ParseCommandLineArgs():
 	parser.add_argument('--no_add',           dest = 'add_im',     action = 'store_false', help = no_add_help)
 	parser.add_argument('--log',  '-l',       dest = 'log',        action = 'store_true',  help = log_help)
 	parser.add_argument('--no_log',           dest = 'log',        action = 'store_false', help = no_log_help)
+	parser.add_argument('--cache',            type = str,          nargs = '?', const = '', help = cache_help)
+	parser.add_argument('--jobs',       '-j', type = int,                                  help = jobs_help)
+	parser.add_argument('--stream',           dest = 'stream',     action = 'store_true',  help = stream_help)
+	parser.add_argument('--backtrack_budget', type = int,                                  help = backtrack_help)
+	parser.add_argument('--seed',             type = int,                                  help = seed_help)
+	parser.add_argument('--count',      '-n', type = int,                                  help = count_help)
+	parser.add_argument('--manifest',         type = str,                                  help = manifest_help)
+	parser.add_argument('--strips',           type = int,                                  help = strips_help)
+	parser.add_argument('--profile',          dest = 'profile',    action = 'store_true',  help = profile_help)
+	parser.add_argument('--profile_phase',    type = str,          choices = PROFILE_PHASES, help = profile_phase_help)
+	parser.add_argument('--profile_memory',   dest = 'profile_memory', action = 'store_true', help = profile_memory_help)
+	parser.add_argument('--save_grid',        dest = 'save_grid',  action = 'store_true',  help = save_grid_help)
+	parser.add_argument('--replay',           type = str,                                  help = replay_help)
+	parser.add_argument('--low_memory',       dest = 'low_memory', action = 'store_true',  help = low_memory_help)
+	parser.add_argument('--classes',          dest = 'classes',    action = 'store_true',  help = classes_help)
+	parser.add_argument('--no_classes',       dest = 'classes',    action = 'store_false', help = no_classes_help)
+	parser.add_argument('--pipeline',         dest = 'pipeline',   action = 'store_true',  help = pipeline_help)
+	parser.add_argument('--preview',          type = float,        metavar = 'SCALE',      help = preview_help)
 	
-	parser.set_defaults(size = size_def, grid = grid_def, path = path_def, out = out_def, add_im = add_im_def, speed_mode = speed_mode_def, log = log_def)
+	parser.set_defaults(
+		size = size_def,
+		grid = grid_def,
+		path = path_def,
+		out = out_def,
+		add_im = add_im_def,
+		speed_mode = speed_mode_def,
+		log = log_def,
+		cache = cache_def,
+		jobs = jobs_def,
+		stream = stream_def,
+		backtrack_budget = backtrack_budget_def,
+		seed = seed_def,
+		count = count_def,
+		manifest = manifest_def,
+		strips = strips_def,
+		profile = profile_def,
+		profile_phase = profile_phase_def,
+		profile_memory = profile_memory_def,
+		save_grid = save_grid_def,
+		replay = replay_def,
+		low_memory = low_memory_def,
+		classes = classes_def,
+		pipeline = pipeline_def,
+		preview = preview_def)
 
-	args = parser.parse_args()
+	#argv defaults to the command line. An empty list gives the defaults of every setting.
+	args = parser.parse_args(argv)
 	
 	return args
 
+class RunContext:
+	#Everything that a single run keeps track of: where it logs to, whether an error occurred, its profiler,
+	#the random number generator that it chooses tiles with and whether it prints its progress.
+	#Each call of the library API runs with a context of its own, so that calls in different threads don't interfere.
+	def __init__(self, do_log = False, log_file = None, profiler = None, rng = random, verbose = True):
+		self.do_log = do_log
+		self.log_file = log_file
+		self.err_occurred = False
+		self.profiler = profiler
+		self.random = rng
+		self.verbose = verbose
+		#(x, y) of the grid being processed within the whole frame, so that logged positions are those of the frame
+		self.origin = (0, 0)
+	
+	def Fork(self, seed = None, origin = (0, 0)):
+		#A context for one part of this run, such as a strip or one picture of a batch.
+		#It logs and profiles along with this one, but tells apart whether that part had an error,
+		#and chooses tiles from its own seed, however the parts are scheduled. Without a seed, it shares this one's tiles choices.
+		#origin is where that part's grid lies within this one's.
+		context = RunContext(self.do_log, self.log_file, self.profiler, random.Random(seed) if seed != None else self.random, self.verbose)
+		context.origin = (self.origin[X] + origin[X], self.origin[Y] + origin[Y])
+		return context
+
+def GetContext():
+	#Code that never set up a context, such as Main, shares a default one
+	context = g_context.get()
+	if context == None:
+		context = RunContext()
+		g_context.set(context)
+	return context
+
+@contextlib.contextmanager
+def UseContext(context):
+	token = g_context.set(context)
+	try:
+		yield context
+	finally:
+		g_context.reset(token)
+
+def GetPositionStr(x, y):
+	#The position of grid space (x, y) of the grid being processed, within the whole frame
+	origin = GetContext().origin
+	return '(' + str(origin[X] + x) + ',' + str(origin[Y] + y) + ')'
+
 def SetupLogging(do_log):
-	global g_do_log, g_log_file
+	context = GetContext()
 	
-	g_do_log = do_log
-	if g_do_log:
-		g_log_file = open(LOG_NAME, 'w')
+	context.do_log = do_log
+	if context.do_log:
+		context.log_file = open(LOG_NAME, 'w')
 		
 def Log(level, statement):
-	global g_do_log, g_log_file, g_err_occurred
+	context = GetContext()
 	
 	log_line = level + ': ' + statement + '\n'
-	if g_do_log:
-		g_log_file.write(log_line)
+	if context.do_log:
+		context.log_file.write(log_line)
 	elif level == ERR:
 		print(log_line)
-		g_err_occurred = True
+		context.err_occurred = True
 
 def CloseLog():
-	global g_do_log, g_log_file
+	context = GetContext()
 	
-	if g_do_log:
-		g_log_file.close()
+	if context.do_log:
+		context.log_file.close()
 		
 		if(os.path.getsize(LOG_NAME)):
 			print('Encountered warnings/errors. See ' + LOG_NAME + ' for details')
 		else:
 			print('No errors encountered whatsoever')
 
-def CreatePictureFromTileGrid(tile_grid, tile_map, frame_width, frame_height):
-	if tile_map == [] or tile_grid == [] or frame_width <= 0 or frame_height <= 0:
+class Profiler:
+	#Records the wall time of each phase, along with counts of events on the hot paths.
+	#Phases may be nested, in which case the outer phase includes the inner one.
+	#A phase which runs several times has its time summed and its peak maxed.
+	#If trace_memory is set, the peak memory of each phase is traced too. Tracing slows down every allocation,
+	#so the times of such a run are inflated, and it only sees memory allocated through Python and NumPy, not by PIL.
+	def __init__(self, cprofile_phase = '', trace_memory = False):
+		self.phases = {}
+		self.counters = {}
+		self.stack = []
+		self.cprofile_phase = cprofile_phase
+		self.cprofile = None
+		self.trace_memory = trace_memory
+		if trace_memory:
+			tracemalloc.start()
+		
+		#Counts may come from the writer thread of a TileRowPipeline while the solver counts too
+		self.count_lock = threading.Lock()
+	
+	def Count(self, name, n = 1):
+		with self.count_lock:
+			self.counters[name] = self.counters.get(name, 0) + n
+	
+	@contextlib.contextmanager
+	def Phase(self, name):
+		#The peak is reset for each phase, so hand the peak so far to the enclosing phase first
+		if self.trace_memory:
+			if len(self.stack) > 0:
+				self.stack[-1]['peak'] = max(self.stack[-1]['peak'], tracemalloc.get_traced_memory()[1])
+			tracemalloc.reset_peak()
+		
+		if name == self.cprofile_phase and self.cprofile == None:
+			self.cprofile = cProfile.Profile()
+		if name == self.cprofile_phase:
+			self.cprofile.enable()
+		
+		self.stack.append({'peak':0, 'start':time.perf_counter()})
+		try:
+			yield
+		finally:
+			frame = self.stack.pop()
+			seconds = time.perf_counter() - frame['start']
+			
+			if name == self.cprofile_phase:
+				self.cprofile.disable()
+			
+			phase = self.phases.setdefault(name, {'seconds':0.0, 'runs':0})
+			phase['seconds'] += seconds
+			phase['runs'] += 1
+			
+			if self.trace_memory:
+				peak = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+				phase['peak_traced_bytes'] = max(phase.get('peak_traced_bytes', 0), peak)
+				if len(self.stack) > 0:
+					self.stack[-1]['peak'] = max(self.stack[-1]['peak'], peak)
+	
+	def Save(self, report_path):
+		if self.trace_memory:
+			tracemalloc.stop()
+		report = {'phases':self.phases, 'counters':self.counters, 'traced_memory':self.trace_memory}
+		
+		try:
+			with open(report_path, 'w') as f:
+				json.dump(report, f, indent = 1)
+			print('Profile written to ' + report_path)
+			
+			if self.cprofile != None:
+				cprofile_path = os.path.splitext(report_path)[0] + '.' + self.cprofile_phase + '.prof'
+				self.cprofile.dump_stats(cprofile_path)
+				print('cProfile stats for the ' + self.cprofile_phase + ' phase written to ' + cprofile_path)
+		except OSError as err:
+			Log(ERR, 'Failed to write profile to "' + report_path + '". Error message: "' + str(err) + '"')
+
+def SetupProfiling(do_profile, cprofile_phase, trace_memory):
+	if do_profile:
+		GetContext().profiler = Profiler(cprofile_phase, trace_memory)
+	elif cprofile_phase != '' or trace_memory:
+		Log(ERR, '--profile_phase and --profile_memory only take effect along with --profile')
+
+def ProfilePhase(name):
+	#Costs next to nothing when not profiling
+	profiler = GetContext().profiler
+	if profiler == None:
+		return contextlib.nullcontext()
+	return profiler.Phase(name)
+
+def CreatePictureFromTileGrid(tile_grid, tile_map, frame_width, frame_height, atlas = None):
+	#atlas is the TileAtlas to render tile_map's tiles from, such as a scaled down one from GetPreviewAtlas
+	if tile_map == {} or tile_grid == [] or frame_width <= 0 or frame_height <= 0:
 		return None
 	
-	tile_size = tile_map[tile_grid[0][0]].im.size
-	new_im = Image.new('RGB', (tile_size[0]*frame_width, tile_size[1]*frame_height))
+	if atlas == None:
+		atlas = TileAtlas(tile_map)
+	pixels = atlas.Render(TileGridToArray(tile_grid))
+	return Image.frombuffer('RGB', (pixels.shape[1], pixels.shape[0]), pixels, 'raw', 'RGB', 0, 1)
+
+def RepaintTileGridRegion(im, tile_grid, tile_map, region):
+	#Paint the tiles of region, an (x, y, width, height) rectangle of tile_grid, over im and leave the rest of im alone.
+	(x, y, width, height) = region
+	tile_size = next(iter(tile_map.values())).im.size
 	
+	grid_array = TileGridToArray([row[x:x + width] for row in tile_grid[y:y + height]])
+	im.paste(Image.fromarray(TileAtlas(tile_map).Render(grid_array), 'RGB'), (x*tile_size[0], y*tile_size[1]))
+
+	return im
+
+class TileAtlas:
+	#Each tile that has been rendered so far, converted to RGB once and stacked into an array of shape (tiles, height, width, 3).
+	#Tiles are added as the grids being rendered come to use them, so a grid can be rendered a row at a time
+	#without knowing up front which tiles the other rows will use. The first entry is a black tile for the erroneous grid spaces.
+	#If tile_size is given, each tile is scaled down (or up) to it as it is added.
+	def __init__(self, tile_map, tile_size = None):
+		self.tile_map = tile_map
+		self.tile_size = tile_size if tile_size != None else next(iter(tile_map.values())).im.size
+		(width, height) = self.tile_size
+		self.pixels = np.zeros((1, height, width, 3), dtype = np.uint8)
+		self.count = 1
+		#Maps each tile id, and ERR_TILE as the last entry, to its index in pixels. 0 until the tile has been added.
+		self.lookup = np.zeros(len(tile_map) + 1, dtype = np.intp)
+		#An atlas from GetPreviewAtlas may be shared by several threads
+		self.lock = threading.Lock()
+	
+	def Add(self, grid_array):
+		#Returns the stack of tiles and the lookup array, which cover every tile of grid_array
+		tile_ids = np.unique(grid_array[grid_array != ERR_TILE])
+		
+		with self.lock:
+			tile_ids = tile_ids[self.lookup[tile_ids] == 0].tolist()
+			
+			if self.count + len(tile_ids) > len(self.pixels):
+				#Double the capacity, so that adding a few tiles per row doesn't copy the whole stack every row
+				pixels = np.zeros((max(self.count + len(tile_ids), 2*len(self.pixels)),) + self.pixels.shape[1:], dtype = np.uint8)
+				pixels[:self.count] = self.pixels[:self.count]
+				self.pixels = pixels
+			
+			#Only kept while adding, so that the atlas doesn't hold on to every tile file it has decoded
+			decoded = {}
+			for tile_id in tile_ids:
+				self.lookup[tile_id] = self.count
+				tile_im = self.tile_map[tile_id].im
+				if isinstance(tile_im, LazyTileImage):
+					tile_im = tile_im.Load(decoded)
+				if tile_im != None: #Stays black otherwise
+					tile_im = tile_im.convert('RGB')
+					if tile_im.size != self.tile_size:
+						tile_im = tile_im.resize(self.tile_size, Image.BOX)
+					self.pixels[self.count] = np.asarray(tile_im)
+				self.count += 1
+			
+			#Tiles added later by other threads don't move the ones already added
+			return (self.pixels[:self.count], self.lookup)
+	
+	def Render(self, grid_array):
+		(pixels, lookup) = self.Add(grid_array)
+		return RenderTileGridArray(grid_array, pixels, lookup)
+
+def GetPreviewAtlas(tile_map, scale):
+	#Returns a TileAtlas of tile_map's tiles scaled by scale, which is kept for later calls with the same tile map and scale,
+	#so that each tile is only scaled down once however many previews are created from it.
+	(width, height) = next(iter(tile_map.values())).im.size
+	tile_size = (max(1, round(width*scale)), max(1, round(height*scale)))
+	
+	#The atlas keeps its tile map alive, so the tile map's id can't be reused while the atlas is kept
+	key = (id(tile_map), tile_size)
+	with g_preview_atlases_lock:
+		atlas = g_preview_atlases.get(key)
+		if atlas == None:
+			atlas = TileAtlas(tile_map, tile_size)
+			g_preview_atlases[key] = atlas
+		
+		g_preview_atlases.move_to_end(key)
+		while len(g_preview_atlases) > PREVIEW_ATLAS_CACHE_SIZE:
+			g_preview_atlases.popitem(last = False)
+	
+	return atlas
+
+def RenderTileGridArray(grid_array, atlas, lookup):
+	#Gather the tiles of each row of grid spaces straight into the picture's buffer, through a view of it
+	#with shape (rows, height, columns, width, 3), so that the tiles are only copied once.
+	(frame_height, frame_width) = grid_array.shape
+	(height, width, channels) = atlas.shape[1:]
+	
+	profiler = GetContext().profiler
+	if profiler != None:
+		profiler.Count('tiles_pasted', int((grid_array != ERR_TILE).sum()))
+	
+	pixels = np.empty((frame_height * height, frame_width * width, channels), dtype = np.uint8)
+	blocks = pixels.reshape(frame_height, height, frame_width, width, channels)
+	tile_indices = lookup[grid_array]
 	for i in range(frame_height):
-		for j in range(frame_width):
-			box = (j*tile_size[0], i*tile_size[1], (j+1)*tile_size[0], (i+1)*tile_size[1])
+		#Every index is in range, and mode = 'clip' lets np.take write to the view without buffering
+		np.take(atlas, tile_indices[i], axis = 0, out = blocks[i].transpose(1, 0, 2, 3), mode = 'clip')
+	return pixels
+
+def SavePictureFromTileGridInBands(tile_grid, tile_map, frame_width, frame_height, out_path, atlas = None):
+	#Same picture as CreatePictureFromTileGrid, but rendered and encoded one row of tiles at a time,
+	#so that only a single band of the picture is ever held in memory.
+	if tile_map == {} or tile_grid == [] or frame_width <= 0 or frame_height <= 0:
+		return False
+	
+	if atlas == None:
+		atlas = TileAtlas(tile_map)
+	writer = OpenBandWriter(out_path, atlas.tile_size[0]*frame_width, atlas.tile_size[1]*frame_height)
+	if writer == None:
+		return False
+	
+	grid_array = TileGridToArray(tile_grid)
+	with writer:
+		for i in range(frame_height):
+			band_im = Image.fromarray(atlas.Render(grid_array[i:i + 1]), 'RGB')
+			writer.WriteBand(band_im)
+			band_im.close()
+	
+	return True
+
+def OpenBandWriter(out_path, width, height):
+	ext = os.path.splitext(out_path)[1].lower()
+	if ext not in STREAM_FORMATS:
+		Log(ERR, 'Cannot stream output to "' + out_path + '". Supported extensions: ' + ', '.join(STREAM_FORMATS))
+		return None
+	
+	try:
+		return STREAM_FORMATS[ext](out_path, width, height)
+	except OSError as err:
+		Log(ERR, 'Failed to open "' + out_path + '" for writing. Error message: "' + str(err) + '"')
+		return None
+
+class RawBandWriter:
+	#Writes bands of RGB rows straight to disk, optionally preceded by a header.
+	def __init__(self, out_path, width, height):
+		self.file = open(out_path, 'wb')
+		self.file.write(self.GetHeader(width, height))
+	
+	def GetHeader(self, width, height):
+		return b''
+	
+	def WriteBand(self, band_im):
+		self.file.write(band_im.tobytes())
+	
+	def close(self):
+		self.file.close()
+	
+	def Abort(self):
+		#Delete the unfinished picture, so that it can't be mistaken for a finished one
+		self.file.close()
+		try:
+			os.remove(self.file.name)
+		except OSError:
+			pass
+	
+	def __enter__(self):
+		return self
+	
+	def __exit__(self, exc_type, exc_value, traceback):
+		if exc_type != None:
+			self.Abort()
+		else:
+			self.close()
+
+class PpmBandWriter(RawBandWriter):
+	def GetHeader(self, width, height):
+		return ('P6\n' + str(width) + ' ' + str(height) + '\n255\n').encode()
+
+class PngBandWriter(RawBandWriter):
+	#A minimal PNG encoder: 8-bit RGB, no interlacing and no filtering, with the image data
+	#compressed as one zlib stream which is split across an IDAT chunk per band.
+	def GetHeader(self, width, height):
+		self.compressor = zlib.compressobj()
+		ihdr = width.to_bytes(4, 'big') + height.to_bytes(4, 'big') + bytes([8, 2, 0, 0, 0])
+		return b'\x89PNG\r\n\x1a\n' + self.GetChunk(b'IHDR', ihdr)
+	
+	def GetChunk(self, chunk_type, data):
+		crc = zlib.crc32(chunk_type + data)
+		return len(data).to_bytes(4, 'big') + chunk_type + data + crc.to_bytes(4, 'big')
+	
+	def WriteBand(self, band_im):
+		#Every scanline starts with its filter type, which is 0 (None) here
+		row_len = band_im.size[0] * 3
+		data = band_im.tobytes()
+		scanlines = b''.join(b'\x00' + data[k:k + row_len] for k in range(0, len(data), row_len))
+		self.WriteIdat(self.compressor.compress(scanlines))
+	
+	def WriteIdat(self, data):
+		if data != b'':
+			self.file.write(self.GetChunk(b'IDAT', data))
+	
+	def close(self):
+		self.WriteIdat(self.compressor.flush())
+		self.file.write(self.GetChunk(b'IEND', b''))
+		self.file.close()
+
+STREAM_FORMATS = {'.png':PngBandWriter, '.ppm':PpmBandWriter, '.raw':RawBandWriter, '.rgb':RawBandWriter}
+
+class TileRowPipeline:
+	#Renders and encodes rows of tiles with writer on a thread of its own, while the rest of the tile grid is still being solved.
+	#Solvers hand each row over to RowDone, in order, once nothing in it will change any more.
+	#The queue is bounded, so a solver which gets ahead of encoding waits instead of piling up rows.
+	def __init__(self, writer, atlas):
+		self.writer = writer
+		self.atlas = atlas
+		self.rows = queue.Queue(maxsize = PIPELINE_QUEUE_ROWS)
+		self.rows_done = 0
+		self.failed = False
+		
+		#The thread logs errors and counts the tiles it pastes to the RunContext of this call.
+		#It is a daemon so that it can never keep the process alive, though Finish or Abort always end it.
+		self.thread = threading.Thread(target = contextvars.copy_context().run, args = (self.WriteRows,), daemon = True)
+		self.thread.start()
+	
+	def RowDone(self, i, row):
+		self.rows.put(row)
+		self.rows_done = i + 1
+	
+	def WriteRows(self):
+		while True:
+			row = self.rows.get()
+			if row == None:
+				break
+			elif self.failed:
+				continue #Keep taking rows off the queue, so that the solver doesn't wait on it forever
 			
-			if tile_grid[i][j] != []:
-				new_im.paste(tile_map[tile_grid[i][j]].im, box)
-			else:
-				#There's an error here. Place a black region instead
-				new_im.paste((0,0,0), box)
+			try:
+				band_im = Image.fromarray(self.atlas.Render(TileGridToArray([row])), 'RGB')
+				self.writer.WriteBand(band_im)
+				band_im.close()
+			except Exception as err:
+				Log(ERR, 'Failed to write a row of tiles to "' + self.writer.file.name + '". Error message: "' + str(err) + '"')
+				self.failed = True
+	
+	def Finish(self, tile_grid):
+		#Hand over the rows which weren't handed over while solving, such as every row in speed mode 3,
+		#then wait for the last of them to be written. Returns whether the picture was saved.
+		for i in range(self.rows_done, len(tile_grid)):
+			self.RowDone(i, tile_grid[i])
+		
+		self.rows.put(None)
+		self.thread.join()
+		if self.failed:
+			self.writer.Abort()
+		else:
+			self.writer.close()
+		return not self.failed
+	
+	def Abort(self):
+		#Stop writing rows, such as when solving was interrupted, and delete the unfinished picture
+		self.rows.put(None)
+		self.thread.join()
+		self.writer.Abort()
 
-	return new_im
+class DeepZoomPyramid:
+	#The layout of a Deep Zoom pyramid of a width x height picture. Level max_level is the picture at full size,
+	#and each level below is half the size of the one above, rounded up, down to a single pixel at level 0.
+	#Each level is cut into pyramid tiles of DZI_TILE_SIZE pixels, saved as "column_row" files in a directory per level.
+	def __init__(self, out_path, width, height):
+		self.out_path = out_path
+		self.files_path = os.path.splitext(out_path)[0] + '_files'
+		self.width = width
+		self.height = height
+		self.max_level = (max(width, height) - 1).bit_length()
+	
+	def GetLevelSize(self, level):
+		scale = self.max_level - level
+		return ((self.width + (1 << scale) - 1) >> scale, (self.height + (1 << scale) - 1) >> scale)
+	
+	def GetTileBoxes(self, level):
+		#Returns the column, row and (left, top, right, bottom) box of each pyramid tile of level
+		(level_width, level_height) = self.GetLevelSize(level)
+		return [(col, row, (x, y, min(x + DZI_TILE_SIZE, level_width), min(y + DZI_TILE_SIZE, level_height)))
+			for (row, y) in enumerate(range(0, level_height, DZI_TILE_SIZE))
+			for (col, x) in enumerate(range(0, level_width, DZI_TILE_SIZE))]
+	
+	def GetTilePath(self, level, col, row):
+		return os.path.join(self.files_path, str(level), str(col) + '_' + str(row) + '.' + DZI_FORMAT)
+	
+	def SaveTile(self, level, col, row, pixels):
+		try:
+			Image.fromarray(pixels, 'RGB').save(self.GetTilePath(level, col, row))
+		except OSError as err:
+			Log(ERR, 'Failed to save pyramid tile "' + self.GetTilePath(level, col, row) + '". Error message: "' + str(err) + '"')
+	
+	def HalveTile(self, level, col, row, box):
+		#Returns the pixels of the pyramid tile at box, made by halving the (up to) four tiles of the level above which it covers.
+		#The tile is black if any of them can't be loaded.
+		(level_width, level_height) = self.GetLevelSize(level + 1)
+		(cols, rows) = ((level_width + DZI_TILE_SIZE - 1) // DZI_TILE_SIZE, (level_height + DZI_TILE_SIZE - 1) // DZI_TILE_SIZE)
+		
+		bands = []
+		for child_row in range(2*row, min(2*row + 2, rows)):
+			band = []
+			for child_col in range(2*col, min(2*col + 2, cols)):
+				child_path = self.GetTilePath(level + 1, child_col, child_row)
+				try:
+					with Image.open(child_path) as child_im:
+						band.append(np.asarray(child_im.convert('RGB')))
+				except OSError as err:
+					Log(ERR, 'Failed to load pyramid tile "' + child_path + '". Error message: "' + str(err) + '"')
+					return np.zeros((box[3] - box[1], box[2] - box[0], 3), dtype = np.uint8)
+			bands.append(np.concatenate(band, axis = 1))
+		
+		return HalvePixels(np.concatenate(bands, axis = 0))
+	
+	def WriteDescriptor(self):
+		descriptor = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+			'<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" TileSize="' + str(DZI_TILE_SIZE) + '" Overlap="0" Format="' + DZI_FORMAT + '">\n'
+			'  <Size Width="' + str(self.width) + '" Height="' + str(self.height) + '"/>\n'
+			'</Image>\n')
+		with open(self.out_path, 'w') as f:
+			f.write(descriptor)
+
+def SaveDeepZoomPyramid(tile_grid, tile_map, frame_width, frame_height, out_path, jobs = 1, atlas = None):
+	#Save the picture as a Deep Zoom pyramid: out_path is the .dzi descriptor, and the pyramid tiles go in the "_files"
+	#directory next to it. Going down from the top level, the tiles of the grid are halved once per level for as long as
+	#their sizes halve exactly, and the levels are rendered from those. Every level after that is made by halving the pyramid
+	#tiles of the level above. Only a few pyramid tiles are held at a time, never the whole picture.
+	#jobs is the number of threads which render and save the pyramid tiles of a level.
+	if tile_map == {} or tile_grid == [] or frame_width <= 0 or frame_height <= 0:
+		return False
+	
+	if atlas == None:
+		atlas = TileAtlas(tile_map)
+	grid_array = TileGridToArray(tile_grid)
+	(pixels, lookup) = atlas.Add(grid_array)
+	(tile_height, tile_width) = pixels.shape[1:3]
+	from_tiles = True
+	
+	pyramid = DeepZoomPyramid(out_path, frame_width*tile_width, frame_height*tile_height)
+	executor = None
+	if jobs > 1:
+		executor = concurrent.futures.ThreadPoolExecutor(max_workers = jobs)
+	
+	for level in range(pyramid.max_level, -1, -1):
+		try:
+			os.makedirs(os.path.join(pyramid.files_path, str(level)), exist_ok = True)
+		except OSError as err:
+			Log(ERR, 'Failed to create pyramid directory in "' + pyramid.files_path + '". Error message: "' + str(err) + '"')
+			break
+		
+		if from_tiles:
+			task = lambda col, row, box: pyramid.SaveTile(level, col, row, RenderTileGridBox(grid_array, pixels, lookup, box))
+		else:
+			task = lambda col, row, box: pyramid.SaveTile(level, col, row, pyramid.HalveTile(level, col, row, box))
+		
+		#Each level is finished before the next, as it may be made from this one. Each thread runs in a copy of
+		#this call's context, so that errors are still logged to its RunContext.
+		boxes = pyramid.GetTileBoxes(level)
+		if executor != None:
+			futures = [executor.submit(contextvars.copy_context().run, task, col, row, box) for (col, row, box) in boxes]
+			for future in futures:
+				future.result()
+		else:
+			for (col, row, box) in boxes:
+				task(col, row, box)
+		
+		if from_tiles and tile_width % 2 == 0 and tile_height % 2 == 0:
+			pixels = HalvePixels(pixels)
+			(tile_height, tile_width) = pixels.shape[1:3]
+		else:
+			from_tiles = False
+	
+	if executor != None:
+		executor.shutdown()
+	
+	try:
+		pyramid.WriteDescriptor()
+	except OSError as err:
+		Log(ERR, 'Failed to save "' + out_path + '". Error message: "' + str(err) + '"')
+		return False
+	
+	return True
+
+def RenderTileGridBox(grid_array, pixels, lookup, box):
+	#Render only box, a (left, top, right, bottom) rectangle of the picture in pixels, from tiles given by pixels and lookup
+	#like RenderTileGridArray's atlas, which may be smaller than the tiles of the tile map.
+	(left, top, right, bottom) = box
+	(tile_height, tile_width) = pixels.shape[1:3]
+	(i, j) = (top // tile_height, left // tile_width)
+	
+	band = RenderTileGridArray(grid_array[i:(bottom + tile_height - 1) // tile_height, j:(right + tile_width - 1) // tile_width], pixels, lookup)
+	return np.ascontiguousarray(band[top - i*tile_height:bottom - i*tile_height, left - j*tile_width:right - j*tile_width])
+
+def HalvePixels(pixels):
+	#Average each 2x2 block of pixels, an array whose last three axes are height, width and channel, rounding halves up.
+	#An odd last row or column is averaged with a copy of itself.
+	(height, width) = pixels.shape[-3:-1]
+	padding = [(0, 0)]*(pixels.ndim - 3) + [(0, height % 2), (0, width % 2), (0, 0)]
+	padded = np.pad(pixels, padding, mode = 'edge').astype(np.uint16)
+	total = padded[..., 0::2, 0::2, :] + padded[..., 0::2, 1::2, :] + padded[..., 1::2, 0::2, :] + padded[..., 1::2, 1::2, :]
+	return ((total + 2) // 4).astype(np.uint8)
 
 def OverwriteTuple(tup, idx, val):
 	#Since tuples are immutable, we have to do a dirty hack to alter single elements within.
@@ -174,27 +1221,198 @@ def OverwriteTuple(tup, idx, val):
 def clip(lower, upper, x):
 	return int(max(lower, min(x, upper)))
 	
-def ProcessTileGridNoCompare(tile_grid, tile_map, frame_width, frame_height):
+def ProcessTileGridWithMode(tile_grid, tile_map, bound_index, frame_width, frame_height, speed_mode, backtrack_budget, row_callback = None):
+	#row_callback, if given, is called with the index and contents of each row as soon as it is solved.
+	#Speed mode 3 can go back on any row until the end, so it never calls it.
+	if speed_mode == NORMAL:
+		return ProcessTileGrid(tile_grid, tile_map, bound_index, frame_width, frame_height, row_callback)
+	elif speed_mode == FAST:
+		return FastProcessTileGrid(tile_grid, tile_map, bound_index, frame_width, frame_height, row_callback)
+	elif speed_mode == NO_COMPARE:
+		return ProcessTileGridNoCompare(tile_grid, tile_map, bound_index, frame_width, frame_height, row_callback)
+	elif speed_mode == BACKTRACK:
+		return BacktrackProcessTileGrid(tile_grid, tile_map, bound_index, frame_width, frame_height, backtrack_budget)
+	else:
+		Log(ERR, 'speed_mode "' + str(speed_mode) + '" does not exist')
+		return []
+
+def StripProcessTileGrid(tile_grid, tile_map, bound_index, frame_width, frame_height, speed_mode, args, jobs):
+	#Split the frame into horizontal strips which are processed in parallel.
+	#The first row of every strip but the first is a seam row. Seam rows are processed first, then each strip is
+	#processed with the seam rows above and below it fixed in place, so that the strips have to fit against them.
+	if tile_grid == [] or speed_mode not in [NORMAL, FAST, NO_COMPARE, BACKTRACK]:
+		return ProcessTileGridWithMode(tile_grid, tile_map, bound_index, frame_width, frame_height, speed_mode, args.backtrack_budget)
+	
+	#Every strip needs a few rows in between its seams to connect them with
+	strips = min(args.strips, frame_height // MIN_STRIP_ROWS)
+	seams = [(k * frame_height) // strips for k in range(1, strips)] if strips > 1 else []
+	if seams == []:
+		return ProcessTileGridWithMode(tile_grid, tile_map, bound_index, frame_width, frame_height, speed_mode, args.backtrack_budget)
+	
+	if speed_mode in [NORMAL, BACKTRACK]:
+		#Prune the whole frame first, so that seam rows are chosen from tiles that can still fit in with the rest.
+		tile_grid = PruneTileGrid(tile_grid, tile_map, bound_index, frame_width, frame_height)
+	
+	#Every task gets its own seed, so that the picture comes out the same however the tasks are scheduled
+	base_seed = GetContext().random.randrange(2**32)
+	
+	#Seam rows are processed from the top down, each along with up to MIN_STRIP_ROWS rows above it and the row below it,
+	#so that it takes the candidates on either side into account. Only the seam row is kept. Before that, the rows from
+	#the seam above down to the row below this one are pruned with the seam above fixed in place. In a strip no taller
+	#than MIN_STRIP_ROWS, the rows above reach the seam above, so the strip in between is sure to connect the two seams.
+	for (k, seam) in enumerate(seams):
+		top = seams[k - 1] if k > 0 else 0
+		sub_grid = tile_grid[top:seam + 2]
+		if k > 0:
+			sub_grid[0] = [[tile_id] if tile_id != [] else [] for tile_id in tile_grid[top]]
+		if speed_mode != NO_COMPARE:
+			PruneTileGrid(sub_grid, tile_map, bound_index, frame_width, len(sub_grid)) #Prunes the rows of tile_grid in place
+		
+		window_top = max(top, seam - MIN_STRIP_ROWS)
+		sub_grid = [list(row) for row in tile_grid[window_top:seam + 2]] #Processing alters the rows it is given
+		if k > 0 and window_top == top:
+			sub_grid[0] = [[tile_id] if tile_id != [] else [] for tile_id in tile_grid[top]]
+		with UseContext(GetContext().Fork(base_seed + k, (0, window_top))) as context:
+			sub_grid = ProcessTileGridWithMode(sub_grid, tile_map, bound_index, frame_width, len(sub_grid), speed_mode, args.backtrack_budget)
+		tile_grid[seam] = sub_grid[-2]
+		SetErrOccurred(context.err_occurred)
+	
+	executor = None
+	if jobs > 1:
+		executor = concurrent.futures.ProcessPoolExecutor(max_workers = jobs, initializer = SetupWorker, initargs = (tile_map, bound_index, args))
+		(map_func, process_func) = (executor.map, ProcessStrip)
+	else:
+		#In this process, the tile set is handed to each task, as other threads may be processing other tile sets
+		(map_func, process_func) = (map, functools.partial(ProcessStrip, tile_set = (tile_map, bound_index, args)))
+	
+	#The seam rows are now fixed, which processing respects as a single candidate per grid space.
+	strip_tasks = []
+	bounds = [0] + seams + [frame_height]
+	for k in range(len(bounds) - 1):
+		(top, bot) = (bounds[k], min(bounds[k + 1] + 1, frame_height))
+		sub_grid = []
+		for i in range(top, bot):
+			if i in seams:
+				sub_grid.append([[tile_id] if tile_id != [] else [] for tile_id in tile_grid[i]])
+			else:
+				sub_grid.append(list(tile_grid[i]))
+		strip_tasks.append((sub_grid, frame_width, len(sub_grid), speed_mode, base_seed + len(seams) + k, top, bounds[k + 1] in seams))
+	for ((sub_grid, err_occurred), k) in zip(map_func(process_func, strip_tasks), range(len(bounds) - 1)):
+		for i in range(bounds[k], min(bounds[k + 1], frame_height)):
+			if i not in seams:
+				tile_grid[i] = sub_grid[i - bounds[k]]
+		SetErrOccurred(err_occurred)
+	
+	if executor != None:
+		executor.shutdown()
+	
+	return tile_grid
+
+def ProcessStrip(task, tile_set = None):
+	#Runs in the worker processes of StripProcessTileGrid, which take the tile set from SetupWorker, or in this process
+	#with the tile set given. Returns the processed grid and whether an error occurred.
+	(tile_map, bound_index, args) = tile_set if tile_set != None else g_worker_tile_set
+	(sub_grid, frame_width, frame_height, speed_mode, seed, top, seam_below) = task
+	
+	with UseContext(GetContext().Fork(seed, (0, top))) as context:
+		if seam_below and speed_mode in [NORMAL, FAST]:
+			sub_grid = ProcessTileGridAboveSeam(sub_grid, tile_map, bound_index, frame_width, frame_height, speed_mode, args.backtrack_budget)
+		else:
+			sub_grid = ProcessTileGridWithMode(sub_grid, tile_map, bound_index, frame_width, frame_height, speed_mode, args.backtrack_budget)
+	
+	return (sub_grid, context.err_occurred)
+
+def ProcessTileGridAboveSeam(tile_grid, tile_map, bound_index, frame_width, frame_height, speed_mode, backtrack_budget):
+	#Speed modes 0 and 1 never go back on a tile, so filling a strip row by row rarely ends in a row that fits the seam
+	#row fixed at its bottom. They only fill the strip down to MIN_STRIP_ROWS rows above the seam, taking the row below that
+	#into account, and the rows left are solved by backtracking in between the last filled row and the seam.
+	split = max(1, frame_height - 1 - MIN_STRIP_ROWS)
+	if speed_mode == NORMAL:
+		with ProfilePhase('prune'):
+			tile_grid = PruneTileGrid(tile_grid, tile_map, bound_index, frame_width, frame_height)
+		fill_grid = FillTileGrid([list(row) for row in tile_grid[:split + 1]], tile_map, bound_index, frame_width, split + 1)
+	else:
+		fill_grid = FastProcessTileGrid([list(row) for row in tile_grid[:split + 1]], tile_map, bound_index, frame_width, split + 1)
+	
+	band = [[[tile_id] if tile_id != [] else [] for tile_id in fill_grid[split - 1]]] + [list(row) for row in tile_grid[split:]]
+	with UseContext(GetContext().Fork(origin = (0, split - 1))) as context:
+		band = BacktrackProcessTileGrid(band, tile_map, bound_index, frame_width, len(band), backtrack_budget)
+	SetErrOccurred(context.err_occurred)
+	
+	return fill_grid[:split] + band[1:]
+
+def SetErrOccurred(err_occurred):
+	context = GetContext()
+	context.err_occurred = context.err_occurred or err_occurred
+
+def ResolveTileGridRegion(tile_grid, cand_grid, tile_map, bound_index, frame_width, frame_height, region, speed_mode, backtrack_budget):
+	#Process region, an (x, y, width, height) rectangle of the already processed tile_grid, again.
+	#The new tiles are chosen from the candidates that cand_grid gives each grid space, or from every tile if cand_grid is None.
+	#The ring of grid spaces around the region is processed along with it, but fixed to its current tiles,
+	#so that the new tiles have to fit against the rest of the picture. Black grid spaces of the ring have no candidates,
+	#so they are left alone and don't constrain the region. Only the region itself is updated in tile_grid.
+	#The work done depends on the size of the region only, not that of the frame.
+	#Returns the region clipped to the frame, or None if it lies outside of it.
+	(x, y, width, height) = region
+	(left, top, right, bot) = (max(x, 0), max(y, 0), min(x + width, frame_width), min(y + height, frame_height))
+	if left >= right or top >= bot:
+		Log(ERR, 'Region ' + str(region) + ' lies outside of the ' + str(frame_width) + 'x' + str(frame_height) + ' frame')
+		return None
+	
+	(sub_left, sub_top, sub_right, sub_bot) = (max(left - 1, 0), max(top - 1, 0), min(right + 1, frame_width), min(bot + 1, frame_height))
+	tile_ids = list(tile_map.keys())
+	sub_grid = []
+	for i in range(sub_top, sub_bot):
+		sub_row = []
+		for j in range(sub_left, sub_right):
+			if top <= i < bot and left <= j < right:
+				sub_row.append(cand_grid[i][j] if cand_grid != None else tile_ids)
+			else:
+				sub_row.append([tile_grid[i][j]] if tile_grid[i][j] != [] else [])
+		sub_grid.append(sub_row)
+	
+	with UseContext(GetContext().Fork(origin = (sub_left, sub_top))) as context:
+		sub_grid = ProcessTileGridWithMode(sub_grid, tile_map, bound_index, sub_right - sub_left, sub_bot - sub_top, speed_mode, backtrack_budget)
+	SetErrOccurred(context.err_occurred)
+	
+	for i in range(top, bot):
+		for j in range(left, right):
+			tile_grid[i][j] = sub_grid[i - sub_top][j - sub_left]
+	
+	return (left, top, right - left, bot - top)
+
+def ProcessTileGridNoCompare(tile_grid, tile_map, bound_index, frame_width, frame_height, row_callback = None):
 	if tile_grid == []:
 		return []
+	
+	rng = GetContext().random
 		
-	#Fill tile grid from left to right, top to bottom.
+	#Fill tile grid from left to right, top to bottom. Grid spaces without candidates stay black.
 	for i in range(frame_height):
 		for j in range(frame_width):
-			tile_grid[i][j] = random.choice(tile_grid[i][j])
+			if tile_grid[i][j] != []:
+				tile_grid[i][j] = ChooseTile(rng, tile_grid[i][j], tile_map)
+		
+		if row_callback != None:
+			row_callback(i, tile_grid[i])
 	
 	return tile_grid
 	
-def FastProcessTileGrid(tile_grid, tile_map, frame_width, frame_height):
+def FastProcessTileGrid(tile_grid, tile_map, bound_index, frame_width, frame_height, row_callback = None):
 	if tile_grid == []:
 		return []
+	
+	rng = GetContext().random
+	bounds_memo = {} #Grid spaces share their lists of candidates, so their boundaries are only gathered once per list
 		
 	#Fill tile grid from left to right, top to bottom.
 	for i in range(frame_height):
 		for j in range(frame_width):
-			id = tile_grid[i][j]
+			if tile_grid[i][j] == []:
+				#Grid spaces without candidates to begin with are deemed invalid and stay black, as they do when pruning
+				continue
 			if i == 0 and j == 0:
-				tile_grid[i][j] = random.choice(tile_grid[i][j])
+				tile_grid[i][j] = ChooseTile(rng, tile_grid[i][j], tile_map)
 				continue
 			
 			#Ignore tile spaces with [], as those are deemed invalid and we do not wish to propagate the error.
@@ -202,77 +1420,51 @@ def FastProcessTileGrid(tile_grid, tile_map, frame_width, frame_height):
 			if i > 0 and tile_grid[i - 1][j] != []:
 				exp_bound[TOP] = [tile_map[tile_grid[i - 1][j]].boundaries[BOT]]
 			if i < frame_height - 1 and tile_grid[i + 1][j] != []:
-				exp_bound[BOT] = list(set(tile.boundaries[TOP] for tile in [tile_map[k] for k in tile_grid[i + 1][j]]))
+				exp_bound[BOT] = GetCandidateBounds(tile_grid[i + 1][j], TOP, tile_map, bounds_memo)
 			if j > 0 and tile_grid[i][j - 1] != []:
 				exp_bound[LEFT] = [tile_map[tile_grid[i][j - 1]].boundaries[RIGHT]]
 			if j < frame_width - 1 and tile_grid[i][j + 1] != []:
-				exp_bound[RIGHT] = list(set([tile.boundaries[LEFT] for tile in [tile_map[k] for k in tile_grid[i][j + 1]]]))
+				exp_bound[RIGHT] = GetCandidateBounds(tile_grid[i][j + 1], LEFT, tile_map, bounds_memo)
 			
-			#Filter items from tile_map to match user's restrictions for this tile space
-			restrict_tile_map = {k:v for k,v in tile_map.items() if k in tile_grid[i][j]}
-			tile_cand_list = GetViableTiles(restrict_tile_map, exp_bound)
+			#Only consider the tiles that match user's restrictions for this tile space
+			tile_cand_list = GetViableTiles(tile_grid[i][j], exp_bound, bound_index)
 			
 			if tile_cand_list == []:
-				Log(ERR, 'Could not find any tile whose boundaries are consistent for the grid area. Using black tile to show erroneous region at position (' + str(j) + ',' + str(i) + ')')
+				Log(ERR, 'Could not find any tile whose boundaries are consistent for the grid area. Using black tile to show erroneous region at position ' + GetPositionStr(j, i))
 				tile_grid[i][j] = []
 			else:
-				tile_grid[i][j] = random.choice(tile_cand_list)
+				tile_grid[i][j] = ChooseTile(rng, tile_cand_list, tile_map)
+		
+		#Later rows only look back at this row, so it is final
+		if row_callback != None:
+			row_callback(i, tile_grid[i])
 	
 	return tile_grid
 
-def ProcessTileGrid(tile_grid, tile_map, frame_width, frame_height):
+def ProcessTileGrid(tile_grid, tile_map, bound_index, frame_width, frame_height, row_callback = None):
 	if tile_grid == []:
 		return []
 	
-	propogate_error = False
-	
 	#Preprocessing step: Prune entries from tile_grid which are not viable.
-	open_set = set()
-	for i in range(frame_height):
-		for j in range(frame_width):
-			open_set.add((j,i))
-	
-	#Impossibility Pruning Loop
-	while len(open_set) > 0:
-		(x,y) = open_set.pop()
-		indices_to_del = []
-		
-		#Ignore tile spaces with [], as those are deemed invalid and we do not wish to propagate the error.
-		exp_bound = {TOP:[], RIGHT:[], BOT:[], LEFT:[]}
-		if y > 0 and tile_grid[y - 1][x] != []:
-			exp_bound[TOP] = list(set([im.boundaries[BOT] for im in [tile_map[k] for k in tile_grid[y - 1][x]]]))
-		if y < frame_height - 1 and tile_grid[y + 1][x] != []:
-			exp_bound[BOT] = list(set([im.boundaries[TOP] for im in [tile_map[k] for k in tile_grid[y + 1][x]]]))
-		if x > 0 and tile_grid[y][x - 1] != []:
-			exp_bound[LEFT] = list(set([im.boundaries[RIGHT] for im in [tile_map[k] for k in tile_grid[y][x - 1]]]))
-		if x < frame_width - 1 and tile_grid[y][x + 1] != []:
-			exp_bound[RIGHT] = list(set([im.boundaries[LEFT] for im in [tile_map[k] for k in tile_grid[y][x + 1]]]))
-		
-		for i, tile_id in enumerate(tile_grid[y][x]):
-			if GetViableTiles({tile_id : tile_map[tile_id]}, exp_bound) == []:
-				indices_to_del.append(i)
-		
-		if len(indices_to_del) > 0:
-			#Delete tile_ids from highest index to lowest index to prevent out of bound errors.
-			for i in reversed(indices_to_del):
-				del tile_grid[y][x][i]
-		
-			#Since this tile_id was modified, add neighbours to the open_set
-			if y > 0 and tile_grid[y - 1][x] != []:
-				open_set.add((x, y - 1))
-			if y < frame_height - 1 and tile_grid[y + 1][x] != []:
-				open_set.add((x, y + 1))
-			if x > 0 and tile_grid[y][x - 1] != []:
-				open_set.add((x - 1, y))
-			if x < frame_width - 1 and tile_grid[y][x + 1] != []:
-				open_set.add((x + 1, y))
-		
-		if tile_grid[y][x] == []:
-			Log(ERR, 'Impossibility Pruning Loop removed ALL candidates from a grid space at position (' + str(x) + ',' + str(y) + '). Check your tile boundary possibilities.')
-			break
-			
-	print('  Finished Pruning Impossibilities.')
-	sys.stdout.flush()
+	with ProfilePhase('prune'):
+		tile_grid = PruneTileGrid(tile_grid, tile_map, bound_index, frame_width, frame_height)
+	if GetContext().verbose:
+		print('  Finished Pruning Impossibilities.')
+		sys.stdout.flush()
+	
+	return FillTileGrid(tile_grid, tile_map, bound_index, frame_width, frame_height, row_callback)
+
+def FillTileGrid(tile_grid, tile_map, bound_index, frame_width, frame_height, row_callback = None):
+	#The fill pass of ProcessTileGrid, for a tile grid which has already been pruned
+	if tile_grid == []:
+		return []
+	
+	propogate_error = False
+	context = GetContext()
+	rng = context.random
+	#Grid spaces share their lists of candidates, so their boundaries and sets are only gathered once per list
+	bounds_memo = {}
+	sets_memo = {}
 	
 	#Fill tile grid from left to right, top to bottom.
 	for i in range(frame_height):
@@ -280,9 +1472,12 @@ def ProcessTileGrid(tile_grid, tile_map, frame_width, frame_height):
 			if propogate_error:
 				tile_grid[i][j] = []
 				continue
+			if tile_grid[i][j] == []:
+				#Grid spaces without candidates to begin with are deemed invalid and stay black, as they do when pruning
+				continue
 				
-			if i == 0 and j == 0 and len(tile_grid[i][j]) > 0:
-				tile_grid[i][j] = random.choice(tile_grid[i][j])
+			if i == 0 and j == 0:
+				tile_grid[i][j] = ChooseTile(rng, tile_grid[i][j], tile_map)
 				continue
 				
 			
@@ -291,32 +1486,37 @@ def ProcessTileGrid(tile_grid, tile_map, frame_width, frame_height):
 			if i > 0 and tile_grid[i - 1][j] != []:
 				exp_bound[TOP] = [tile_map[tile_grid[i - 1][j]].boundaries[BOT]]
 			if i < frame_height - 1 and tile_grid[i + 1][j] != []:
-				exp_bound[BOT] = list(set([tile.boundaries[TOP] for tile in [tile_map[k] for k in tile_grid[i + 1][j]]]))
+				exp_bound[BOT] = GetCandidateBounds(tile_grid[i + 1][j], TOP, tile_map, bounds_memo)
 			if j > 0 and tile_grid[i][j - 1] != []:
 				exp_bound[LEFT] = [tile_map[tile_grid[i][j - 1]].boundaries[RIGHT]]
 			if j < frame_width - 1 and tile_grid[i][j + 1] != []:
-				exp_bound[RIGHT] = list(set([tile.boundaries[LEFT] for tile in [tile_map[k] for k in tile_grid[i][j + 1]]]))
+				exp_bound[RIGHT] = GetCandidateBounds(tile_grid[i][j + 1], LEFT, tile_map, bounds_memo)
 			
-			#Filter items from tile_map to match user's restrictions for this tile space
-			restrict_tile_map = {k:v for k,v in tile_map.items() if k in tile_grid[i][j]}
-			tile_cand_list = GetViableTiles(restrict_tile_map, exp_bound)
+			#Only consider the tiles that match user's restrictions for this tile space
+			tile_cand_list = GetViableTiles(tile_grid[i][j], exp_bound, bound_index)
 
-			if tile_cand_list != [] and i > 0 and j < frame_width - 1:
+			if tile_cand_list != [] and i > 0 and j < frame_width - 1 and tile_grid[i][j + 1] != []:
 				#Need to also take into account the tile that was placed in the diagonally upper-right position
 				#so that we don't choose a tile that will leave the grid space to the right without options
 				exp_bound_right = {TOP:[], RIGHT:[], BOT:[], LEFT:[]}
-				exp_bound_right[TOP] = [tile_map[tile_grid[i - 1][j + 1]].boundaries[BOT]]
+				if tile_grid[i - 1][j + 1] != []:
+					exp_bound_right[TOP] = [tile_map[tile_grid[i - 1][j + 1]].boundaries[BOT]]
 				if i < frame_height - 1 and tile_grid[i + 1][j + 1] != []:
-					exp_bound_right[BOT] = list(set([tile.boundaries[TOP] for tile in [tile_map[k] for k in tile_grid[i + 1][j + 1]]]))
+					exp_bound_right[BOT] = GetCandidateBounds(tile_grid[i + 1][j + 1], TOP, tile_map, bounds_memo)
 				if j < frame_width - 2 and tile_grid[i][j + 2] != []:
-					exp_bound_right[RIGHT] = list(set([tile.boundaries[LEFT] for tile in [tile_map[k] for k in tile_grid[i][j + 2]]]))
-
-				right_tile_map = {k:v for k,v in tile_map.items() if k in tile_grid[i][j + 1]}
+					exp_bound_right[RIGHT] = GetCandidateBounds(tile_grid[i][j + 2], LEFT, tile_map, bounds_memo)
 				
+				#Whether a candidate leaves the grid space to the right any options only depends on its RIGHT boundary,
+				#so only check each distinct boundary once, and only for whether any tile fits
+				right_cands = GetCandidateSet(tile_grid[i][j + 1], sets_memo)
+				right_fits = {}
 				indices_to_del = []
 				for k, tile_cand in enumerate(tile_cand_list):
-					exp_bound_right[LEFT] = [tile_map[tile_cand].boundaries[RIGHT]]
-					if GetViableTiles(right_tile_map, exp_bound_right) == []:
+					bound = tile_map[tile_cand].boundaries[RIGHT]
+					if bound not in right_fits:
+						exp_bound_right[LEFT] = [bound]
+						right_fits[bound] = HasViableTile(right_cands, exp_bound_right, bound_index)
+					if not right_fits[bound]:
 						indices_to_del.append(k)
 				
 				if len(indices_to_del) > 0:
@@ -324,12 +1524,15 @@ def ProcessTileGrid(tile_grid, tile_map, frame_width, frame_height):
 					for k in reversed(indices_to_del):
 						del tile_cand_list[k]
 					
+					if context.profiler != None:
+						context.profiler.Count('lookahead_rejections', len(indices_to_del))
+					
 			if tile_cand_list == [] or propogate_error:
 				tile_grid[i][j] = []
 				
 				if not propogate_error:
 					Log(ERR, 'Could not find any tile whose boundaries are consistent for the grid area. '
-						'Using black tile to show erroneous region at position (' + str(j) + ',' + str(i) + '). '
+						'Using black tile to show erroneous region at position ' + GetPositionStr(j, i) + '. '
 						'The rest of the picture from here on out will be black.')
 				
 				#Typically if we hit here there's something wrong with the tiles
@@ -337,73 +1540,616 @@ def ProcessTileGrid(tile_grid, tile_map, frame_width, frame_height):
 				#It's easier on the developer's part to black out the rest of the picture
 				propogate_error = True 
 			else:
-				tile_grid[i][j] = random.choice(tile_cand_list)
+				tile_grid[i][j] = ChooseTile(rng, tile_cand_list, tile_map)
+		
+		#Later rows only look back at this row, so it is final
+		if row_callback != None:
+			row_callback(i, tile_grid[i])
 
 	return tile_grid
 	
+def BacktrackProcessTileGrid(tile_grid, tile_map, bound_index, frame_width, frame_height, backtrack_budget = 10000):
+	if tile_grid == []:
+		return []
+	
+	solver = BacktrackSolver(tile_grid, tile_map, bound_index, frame_width, frame_height)
+	is_solved = solver.Solve(backtrack_budget)
+	
+	if not is_solved:
+		Log(ERR, 'Could not find a way to fit the tiles together after ' + str(solver.backtracks) + ' backtracks. '
+			'Using black tiles to show the grid spaces which could not be decided. '
+			'Check your tile boundary possibilities, or raise the backtrack budget.')
+	
+	#Grid spaces with a single candidate left are decided. Any others are erroneous and left black.
+	for i in range(frame_height):
+		for j in range(frame_width):
+			tile_ids = BitsetToIds(solver.domains[i][j])
+			tile_grid[i][j] = tile_ids[0] if len(tile_ids) == 1 else []
+	
+	return tile_grid
+
+class BacktrackSolver:
+	#Fills the grid space with the fewest candidates (lowest entropy) first, propagates the consequences to the
+	#rest of the grid, and undoes its most recent choice if some grid space is left without candidates.
+	#Candidates are held as bitsets, and every change to them is recorded on a trail so that it can be undone.
+	def __init__(self, tile_grid, tile_map, bound_index, frame_width, frame_height):
+		self.tile_map = tile_map
+		self.bound_masks = GetBoundaryMasks(bound_index)
+		self.frame_width = frame_width
+		self.frame_height = frame_height
+		self.allowed_memo = {}
+		self.trail = []
+		self.heap = []
+		self.backtracks = 0
+		self.rng = GetContext().random
+		self.profiler = GetContext().profiler
+		
+		bitset_memo = {}
+		self.domains = [[0] * frame_width for i in range(frame_height)]
+		for i in range(frame_height):
+			for j in range(frame_width):
+				if id(tile_grid[i][j]) not in bitset_memo:
+					bitset_memo[id(tile_grid[i][j])] = IdsToBitset(tile_grid[i][j])
+				self.domains[i][j] = bitset_memo[id(tile_grid[i][j])]
+		
+		#Tile spaces which start out with no candidates are deemed invalid and we do not wish to propagate the error.
+		self.is_invalid = [[self.domains[i][j] == 0 for j in range(frame_width)] for i in range(frame_height)]
+	
+	def Solve(self, backtrack_budget):
+		open_list = []
+		for i in range(self.frame_height):
+			for j in range(self.frame_width):
+				if not self.is_invalid[i][j]:
+					self.PushCell(j, i)
+					open_list.append((j, i))
+		
+		if not self.Propagate(open_list):
+			#Not even the grid spaces as they were given fit together, so there is nothing consistent to keep
+			self.domains = [[0] * self.frame_width for i in range(self.frame_height)]
+			return False
+		
+		decisions = [] #(x, y, trail length before the choice, chosen tile id)
+		while True:
+			cell = self.PopLowestEntropyCell()
+			if cell == None:
+				return True
+			
+			(x, y) = cell
+			tile_id = ChooseTile(self.rng, BitsetToIds(self.domains[y][x]), self.tile_map)
+			decisions.append((x, y, len(self.trail), tile_id))
+			consistent_len = len(self.trail)
+			is_consistent = self.Restrict(x, y, 1 << tile_id)
+			
+			while not is_consistent:
+				if decisions == [] or self.backtracks >= backtrack_budget:
+					#Go back to before the failed restriction, where every grid space still fits its neighbours,
+					#so that the grid spaces which were decided by then can be kept
+					self.Undo(consistent_len)
+					return False
+				
+				#Undo the latest choice and everything that followed from it, then rule that tile out instead
+				(x, y, trail_len, tile_id) = decisions.pop()
+				self.Undo(trail_len)
+				self.backtracks += 1
+				if self.profiler != None:
+					self.profiler.Count('backtracks')
+				consistent_len = len(self.trail)
+				is_consistent = self.Restrict(x, y, self.domains[y][x] & ~(1 << tile_id))
+	
+	def Restrict(self, x, y, bitset):
+		if bitset == 0:
+			return False
+		
+		self.SetDomain(x, y, bitset)
+		return self.Propagate([(x, y)])
+	
+	def Propagate(self, open_list):
+		#Remove candidates from the neighbours of changed grid spaces until nothing changes.
+		#Returns False as soon as a grid space runs out of candidates.
+		open_list = deque(open_list)
+		while len(open_list) > 0:
+			(x, y) = open_list.popleft()
+			
+			for dir in DIRS:
+				(nx, ny) = (x + DIR_OFFSET[dir][X], y + DIR_OFFSET[dir][Y])
+				if nx < 0 or nx >= self.frame_width or ny < 0 or ny >= self.frame_height or self.is_invalid[ny][nx]:
+					continue
+				
+				bitset = self.domains[ny][nx] & self.GetAllowedBitset(dir, self.domains[y][x])
+				if bitset != self.domains[ny][nx]:
+					if bitset == 0:
+						return False
+					self.SetDomain(nx, ny, bitset)
+					open_list.append((nx, ny))
+		
+		return True
+	
+	def GetAllowedBitset(self, dir, bitset):
+		#All tiles which can be placed in direction dir of a grid space with the candidates in bitset
+		if (dir, bitset) not in self.allowed_memo:
+			if len(self.allowed_memo) >= BACKTRACK_MEMO_SIZE:
+				self.allowed_memo.clear()
+			
+			allowed = 0
+			for bound in set(self.tile_map[k].boundaries[dir] for k in BitsetToIds(bitset)):
+				allowed |= self.bound_masks[OPP[dir]].get(bound, 0)
+			self.allowed_memo[(dir, bitset)] = allowed
+		
+		return self.allowed_memo[(dir, bitset)]
+	
+	def SetDomain(self, x, y, bitset):
+		self.trail.append((x, y, self.domains[y][x]))
+		self.domains[y][x] = bitset
+		self.PushCell(x, y)
+	
+	def Undo(self, trail_len):
+		while len(self.trail) > trail_len:
+			(x, y, bitset) = self.trail.pop()
+			self.domains[y][x] = bitset
+			self.PushCell(x, y)
+	
+	def PushCell(self, x, y):
+		#The heap may hold outdated entries for a grid space. Those are skipped when popped.
+		#Ties are broken randomly, so that the picture isn't filled in the same order every time.
+		heapq.heappush(self.heap, (bin(self.domains[y][x]).count('1'), self.rng.random(), x, y))
+	
+	def PopLowestEntropyCell(self):
+		while len(self.heap) > 0:
+			(count, tie_break, x, y) = heapq.heappop(self.heap)
+			if count > 1 and count == bin(self.domains[y][x]).count('1'):
+				return (x, y)
+		
+		return None
+
+def PruneTileGrid(tile_grid, tile_map, bound_index, frame_width, frame_height):
+	#Impossibility Pruning Loop. Each grid space's candidates are held as a bitset, where bit k is set if tile k is a candidate.
+	#For each direction, a grid space also counts how many of its neighbour's candidates have each boundary.
+	#Removing a candidate only decrements the counts that it contributed to, and a tile is only removed once
+	#the count for its boundary drops to zero, so the work done is proportional to what actually gets removed.
+	bound_masks = GetBoundaryMasks(bound_index)
+	profiler = GetContext().profiler
+	
+	bitset_memo = {} #Grid spaces frequently share their list of candidates, so only convert each list once
+	domains = [[0] * frame_width for i in range(frame_height)]
+	for i in range(frame_height):
+		for j in range(frame_width):
+			if id(tile_grid[i][j]) not in bitset_memo:
+				bitset_memo[id(tile_grid[i][j])] = IdsToBitset(tile_grid[i][j])
+			domains[i][j] = bitset_memo[id(tile_grid[i][j])]
+	
+	#supports[i][j][dir] maps a boundary to the number of candidates in the neighbouring space that match it.
+	#Tile spaces with no candidates are deemed invalid and we do not wish to propagate the error, so they get no entry.
+	support_memo = {}
+	supports = [[{} for j in range(frame_width)] for i in range(frame_height)]
+	open_list = deque()
+	for i in range(frame_height):
+		for j in range(frame_width):
+			removed = 0
+			
+			for dir in DIRS:
+				(x, y) = (j + DIR_OFFSET[dir][X], i + DIR_OFFSET[dir][Y])
+				if x < 0 or x >= frame_width or y < 0 or y >= frame_height or domains[y][x] == 0:
+					continue
+				
+				if (dir, domains[y][x]) not in support_memo:
+					counts = {}
+					for k in BitsetToIds(domains[y][x]):
+						bound = tile_map[k].boundaries[OPP[dir]]
+						counts[bound] = counts.get(bound, 0) + 1
+					
+					allowed = 0
+					for bound in counts:
+						allowed |= bound_masks[dir].get(bound, 0)
+					support_memo[(dir, domains[y][x])] = (counts, allowed)
+				
+				(counts, allowed) = support_memo[(dir, domains[y][x])]
+				supports[i][j][dir] = dict(counts)
+				removed |= domains[i][j] & ~allowed
+			
+			if removed != 0:
+				open_list.append((j, i, removed))
+	
+	#The counts were taken from the unpruned candidates, so only remove the unsupported tiles now that all counts exist.
+	#Pruning stops as soon as a grid space is left without candidates, so that the error doesn't spread to other grid spaces.
+	emptied = None
+	for (x, y, removed) in open_list:
+		domains[y][x] &= ~removed
+		if profiler != None:
+			profiler.Count('prune_removals', bin(removed).count('1'))
+		if domains[y][x] == 0:
+			emptied = (x, y)
+			break
+	
+	while len(open_list) > 0 and emptied == None:
+		(x, y, removed) = open_list.popleft()
+		if profiler != None:
+			profiler.Count('prune_iterations')
+		
+		#Tell the neighbours that the removed tiles no longer support their candidates
+		for k in BitsetToIds(removed):
+			for dir in DIRS:
+				(nx, ny) = (x + DIR_OFFSET[dir][X], y + DIR_OFFSET[dir][Y])
+				if nx < 0 or nx >= frame_width or ny < 0 or ny >= frame_height or OPP[dir] not in supports[ny][nx]:
+					continue
+				
+				bound = tile_map[k].boundaries[dir]
+				counts = supports[ny][nx][OPP[dir]]
+				counts[bound] -= 1
+				if counts[bound] == 0:
+					lost = domains[ny][nx] & bound_masks[OPP[dir]].get(bound, 0)
+					if lost != 0:
+						domains[ny][nx] &= ~lost
+						open_list.append((nx, ny, lost))
+						if profiler != None:
+							profiler.Count('prune_removals', bin(lost).count('1'))
+						if domains[ny][nx] == 0:
+							emptied = (nx, ny)
+							break
+			
+			if emptied != None:
+				break
+	
+	if emptied != None:
+		Log(ERR, 'Impossibility Pruning Loop removed ALL candidates from a grid space at position ' + GetPositionStr(emptied[X], emptied[Y]) + '. Check your tile boundary possibilities.')
+	
+	#Only replace the grid spaces which lost candidates. The others keep sharing their original lists.
+	ids_memo = {}
+	for i in range(frame_height):
+		for j in range(frame_width):
+			if domains[i][j] != bitset_memo[id(tile_grid[i][j])]:
+				if domains[i][j] not in ids_memo:
+					ids_memo[domains[i][j]] = BitsetToIds(domains[i][j])
+				tile_grid[i][j] = ids_memo[domains[i][j]]
+	
+	return tile_grid
+
 def GetTileGridFromFile(grid_path, tile_map):
-	if grid_path == '' or tile_map == []:
+	#A grid yaml file has an 'id' map from each grid id to the names of the tile files that may go in its grid spaces,
+	#and a 'grid' with the grid id of every grid space. 'grid' is either a list of rows, or the name of a CSV file
+	#with a row of grid ids per line, or of a .npy file with an integer array of grid ids, relative to the yaml file.
+	#CSV and .npy files are read a row at a time.
+	if grid_path == '' or tile_map == {}:
 		return ([], -1, -1)
 	
-	#Instantiate tile_grid with Nones, which will be filled in
-	tile_grid = []
-	(frame_width, frame_height) = (-1, -1)
-	yaml_obj = None
-	
 	try:
 		with open(grid_path) as f:
-			yaml_obj = yaml.load(f)
+			yaml_obj = yaml.load(f, Loader = YAML_LOADER)
 	except Exception as err:
 		Log(ERR, 'Failed to get tile grid from path "' + grid_path + '". Error message: "' + str(err) + '"')
 		return ([], -1, -1)
 	
-	#Get Parameters from the yaml file
-	id_map = {} #A map from the identifier used in the yaml file to acceptable tile_map indices
-	for id, im_list in yaml_obj['id'].items():
-		id_map[id] = [k for k,v in tile_map.items() if os.path.basename(v.im.filename) in im_list]
-	tile_grid = deepcopy(yaml_obj['grid'])
-	frame_width = len(tile_grid[0])
-	frame_height = len(tile_grid)
+	#Index the tiles by file name once, instead of checking every tile against every grid id
+	file_ids = {}
+	for (k, tile) in tile_map.items():
+		file_ids.setdefault(os.path.basename(tile.filename), []).append(k)
+	
+	#A map from the grid ids used in the file to acceptable tile_map indices. Grid ids are compared as strings,
+	#as CSV files have no types. Every grid space with the same grid id shares its list,
+	#as processing replaces a grid space's list instead of altering it.
+	id_map = {}
+	for (id, im_list) in yaml_obj['id'].items():
+		if type(im_list) != list:
+			Log(ERR, 'Grid id ' + str(id) + ' in "' + grid_path + '" does not map to a list of tile file names')
+			return ([], -1, -1)
+		id_map[GridIdToStr(id)] = sorted(k for name in set(im_list) for k in file_ids.get(name, []))
+		if id_map[GridIdToStr(id)] == []:
+			Log(ERR, 'Grid id ' + str(id) + ' in "' + grid_path + '" matches none of the tile files, so its grid spaces will be black')
 	
 	#Preprocessing Step: Replace each entry in tile grid with list of potential tile ids
-	for i in range(frame_height):
-		for j in range(frame_width):
-			tile_grid[i][j] = deepcopy(id_map[tile_grid[i][j]])
+	tile_grid = []
+	try:
+		for row in ReadGridRows(yaml_obj['grid'], os.path.dirname(grid_path)):
+			tile_grid.append([id_map[GridIdToStr(id)] for id in row])
+	except KeyError as err:
+		Log(ERR, 'Grid id ' + str(err) + ' in "' + grid_path + '" is not in its id map')
+		return ([], -1, -1)
+	except (OSError, ValueError) as err:
+		Log(ERR, 'Failed to get tile grid from path "' + grid_path + '". Error message: "' + str(err) + '"')
+		return ([], -1, -1)
 	
-	return (tile_grid, frame_width, frame_height)
+	if tile_grid == [] or any(len(row) != len(tile_grid[0]) for row in tile_grid):
+		Log(ERR, 'The rows of the tile grid in "' + grid_path + '" are not all of the same length')
+		return ([], -1, -1)
+	
+	return (tile_grid, len(tile_grid[0]), len(tile_grid))
+
+def GridIdToStr(id):
+	#Whole numbers are written without a decimal point, so that a grid id of 1 matches 1.0 from a float array or yaml file
+	if type(id) == float and id.is_integer():
+		id = int(id)
+	return str(id)
+
+def ReadGridRows(grid, base_path):
+	#Yields the rows of grid ids that the 'grid' of a grid yaml file holds or names
+	if type(grid) != str:
+		yield from grid
+		return
+	
+	path = os.path.join(base_path, grid)
+	if os.path.splitext(path)[1].lower() == '.npy':
+		grid_array = np.load(path, mmap_mode = 'r')
+		if grid_array.ndim != 2:
+			raise ValueError('"' + path + '" does not hold a 2D array')
+		for row in grid_array:
+			yield row.tolist()
+	else:
+		with open(path, newline = '') as f:
+			for row in csv.reader(f):
+				if row != []:
+					yield [id.strip() for id in row]
+
+def TileGridToArray(tile_grid):
+	#A processed tile grid as an int32 array of shape (height, width), with ERR_TILE for the erroneous grid spaces
+	return np.array([[tile_id if tile_id != [] else ERR_TILE for tile_id in row] for row in tile_grid], dtype = np.int32)
+
+def ArrayToTileGrid(grid_array):
+	return [[tile_id if tile_id != ERR_TILE else [] for tile_id in row] for row in grid_array.tolist()]
+
+def GetTileSetFingerprint(tile_map):
+	#Changes whenever any tile's pixels or its tile id do
+	fingerprint = hashlib.blake2b(digest_size = 16)
+	for k in sorted(tile_map.keys()):
+		fingerprint.update(GetImageDigest(tile_map[k].im))
+	return fingerprint.hexdigest()
+
+def SaveSolvedGrid(grid_path, tile_grid, tile_map):
+	#Save a processed tile grid as GRID_MAGIC, the length of a json header, the header, then the tile ids as an int32 array
+	#of shape (height, width). The header has the fingerprint of the tile set, and the file name, transform and digest of
+	#each tile id, so that the grid can still be matched up with its tiles if the tile set changes.
+	grid_array = TileGridToArray(tile_grid)
+	tiles = [[os.path.basename(tile_map[k].filename), list(tile_map[k].transform), GetImageDigest(tile_map[k].im).hex()]
+		for k in range(len(tile_map))]
+	header = {'version':GRID_VERSION, 'width':grid_array.shape[1] if grid_array.ndim == 2 else 0, 'height':grid_array.shape[0],
+		'fingerprint':GetTileSetFingerprint(tile_map), 'tiles':tiles}
+	header_data = json.dumps(header).encode()
+	#Pad the header so that the array starts on an aligned offset
+	header_data += b' ' * (-(len(GRID_MAGIC) + 8 + len(header_data)) % CACHE_ALIGN)
+	
+	try:
+		with open(grid_path, 'wb') as f:
+			f.write(GRID_MAGIC)
+			f.write(len(header_data).to_bytes(8, 'little'))
+			f.write(header_data)
+			f.write(grid_array.astype('<i4').tobytes())
+	except OSError as err:
+		Log(ERR, 'Failed to save solved tile grid to "' + grid_path + '". Error message: "' + str(err) + '"')
+
+def LoadSolvedGrid(grid_path, tile_map):
+	#Returns the processed tile grid saved by SaveSolvedGrid, along with its width and height
+	try:
+		with open(grid_path, 'rb') as f:
+			if f.read(len(GRID_MAGIC)) != GRID_MAGIC:
+				raise ValueError('not a solved tile grid')
+			header_len = int.from_bytes(f.read(8), 'little')
+			header = json.loads(f.read(header_len).decode())
+			if header['version'] != GRID_VERSION:
+				raise ValueError('unsupported version ' + str(header['version']))
+			
+			(frame_width, frame_height) = (header['width'], header['height'])
+			grid_array = np.frombuffer(f.read(frame_width * frame_height * 4), dtype = '<i4')
+			grid_array = grid_array.reshape((frame_height, frame_width)).astype(np.int32)
+	except (OSError, ValueError, KeyError) as err:
+		Log(ERR, 'Failed to get solved tile grid from path "' + grid_path + '". Error message: "' + str(err) + '"')
+		return ([], -1, -1)
+	
+	if header['fingerprint'] != GetTileSetFingerprint(tile_map):
+		#The tiles have changed since. Match the saved tile ids up with the current ones by file name and transform,
+		#or failing that by their pixels, as removing duplicates may have kept another file's copy of a tile.
+		Log(WARN, 'The tiles have changed since "' + grid_path + '" was saved. Matching its tiles up by file name')
+		tile_ids = {(os.path.basename(tile.filename), tuple(tile.transform)):k for (k, tile) in tile_map.items()}
+		digest_ids = {GetImageDigest(tile.im).hex():k for (k, tile) in tile_map.items()}
+		remap = np.full(len(header['tiles']) + 1, ERR_TILE, dtype = np.int32) #The last entry maps ERR_TILE to itself
+		for (k, (filename, transform, digest)) in enumerate(header['tiles']):
+			remap[k] = tile_ids.get((filename, tuple(transform)), digest_ids.get(digest, ERR_TILE))
+			if remap[k] == ERR_TILE and (grid_array == k).any():
+				Log(ERR, 'Tile "' + filename + '" with transform ' + str(tuple(transform)) + ' is no longer in the tile set. '
+					'Using black tiles in its place')
+		grid_array = remap[grid_array]
+	
+	return (ArrayToTileGrid(grid_array), frame_width, frame_height)
 
 def ConstructTileGrid(tile_map, frame_width, frame_height):
 	if tile_map == {} or frame_width <= 0 or frame_height <= 0:
 		return []
 	
-	#Instantiate tile_grid with each grid space having access to all tile keys
-	tile_grid = []
-	for i in range(frame_height):
-		tile_row = []
-		for j in range(frame_width):
-			tile_row.append(deepcopy(list(tile_map.keys())))
-		tile_grid.append(tile_row)
+	#Instantiate tile_grid with each grid space having access to all tile keys.
+	#Every grid space shares the same list, as processing replaces a grid space's list instead of altering it.
+	tile_ids = list(tile_map.keys())
+	tile_grid = [[tile_ids] * frame_width for i in range(frame_height)]
 	
 	return tile_grid
 
-def GetViableTiles(tile_map, exp_bound):
-	tile_cand_list = []
+def ChooseTile(rng, tile_ids, tile_map):
+	#A TileClass is weighted by its number of tiles, so that every tile is as likely to be picked as when solving without classes.
+	#GetTileClasses makes sure that a grid space allows either all of a class's tiles or none of them.
+	if len(tile_ids) == 0 or not isinstance(tile_map[tile_ids[0]], TileClass):
+		return rng.choice(tile_ids)
+	return rng.choices(tile_ids, weights = [tile_map[k].weight for k in tile_ids])[0]
+
+def GetTileClasses(tile_map, tile_grid = []):
+	#Group the tiles by their (TOP, RIGHT, BOT, LEFT) boundaries, and by which of tile_grid's lists of candidates they are in.
+	#So a grid space allows either all of the tiles of a class or none of them, and weighting a class by its number of tiles
+	#weights it by the number of the grid space's candidates in it. Returns a map from class id to TileClass,
+	#and a map from tile id to class id.
+	cand_lists = {}
+	for row in tile_grid:
+		for tile_ids in row:
+			cand_lists.setdefault(id(tile_ids), tile_ids)
 	
-	for (i,tile) in tile_map.items():
-		is_viable = True
+	#Lists with the same candidates tell tiles apart no better than one of them
+	in_lists = {k:[] for k in tile_map}
+	for (n, tile_ids) in enumerate(set(frozenset(tile_ids) for tile_ids in cand_lists.values())):
+		for k in tile_ids:
+			in_lists[k].append(n)
+	
+	class_ids = {}
+	tile_class = {}
+	for (k, tile) in tile_map.items():
+		signature = tuple(tile.boundaries[dir] for dir in DIRS) + (tuple(in_lists[k]),)
+		tile_class[k] = class_ids.setdefault(signature, len(class_ids))
+	
+	members = [[] for c in range(len(class_ids))]
+	for (k, c) in tile_class.items():
+		members[c].append(k)
+	class_map = {c:TileClass(members[c], tile_map) for c in range(len(members))}
+	
+	return (class_map, tile_class)
+
+def GetClassGrid(tile_grid, tile_class):
+	#Replace the candidate tiles of each grid space with their classes.
+	#Grid spaces which share a list of candidates share the list of classes too.
+	class_memo = {}
+	class_grid = []
+	for row in tile_grid:
+		class_row = []
+		for tile_ids in row:
+			if id(tile_ids) not in class_memo:
+				class_memo[id(tile_ids)] = list(dict.fromkeys(tile_class[k] for k in tile_ids))
+			class_row.append(class_memo[id(tile_ids)])
+		class_grid.append(class_row)
+	
+	return class_grid
+
+def ExpandClassRow(class_row, tile_row, tile_class, rng, members_memo):
+	#Returns a row with a tile of each grid space's solved class, out of the candidates that tile_row gave that grid space.
+	#members_memo maps each list of candidates to its candidates by class, and may be shared between rows.
+	row = []
+	for (c, tile_ids) in zip(class_row, tile_row):
+		if c == []:
+			row.append([])
+			continue
 		
+		if id(tile_ids) not in members_memo:
+			members = {}
+			for k in tile_ids:
+				members.setdefault(tile_class[k], []).append(k)
+			members_memo[id(tile_ids)] = members
+		row.append(rng.choice(members_memo[id(tile_ids)][c]))
+	
+	return row
+
+class ClassRowExpander:
+	#Picks the tiles of each row of a class grid as soon as the row is solved, and hands the row of tiles on to row_callback.
+	#Tiles are picked in row order with rng, which nothing else uses,
+	#so the same tiles are picked whether rows are handed over while solving or after it.
+	def __init__(self, tile_grid, tile_class, rng, row_callback = None):
+		self.tile_grid = tile_grid
+		self.tile_class = tile_class
+		self.rng = rng
+		self.row_callback = row_callback
+		self.members_memo = {}
+		self.rows = []
+	
+	def RowDone(self, i, class_row):
+		row = ExpandClassRow(class_row, self.tile_grid[i], self.tile_class, self.rng, self.members_memo)
+		self.rows.append(row)
+		if self.row_callback != None:
+			self.row_callback(i, row)
+	
+	def Finish(self, class_grid):
+		#Expand the rows which weren't handed over while solving, and return the tile grid
+		for i in range(len(self.rows), len(class_grid)):
+			self.RowDone(i, class_grid[i])
+		return self.rows
+
+def GetBoundaryIndex(tile_map):
+	#For each direction, map every boundary to the set of tile ids which have that boundary on that side.
+	#Built once, so that finding viable tiles is a few set intersections instead of a scan over every tile.
+	bound_index = {TOP:{}, RIGHT:{}, BOT:{}, LEFT:{}}
+	
+	for (i,tile) in tile_map.items():
 		for dir in [TOP, RIGHT, BOT, LEFT]:
-			is_viable &= tile.CompareBoundaries(dir, exp_bound[dir])
+			bound_index[dir].setdefault(tile.boundaries[dir], set()).add(i)
+	
+	return bound_index
+
+def GetBoundaryMasks(bound_index):
+	#Same as the boundary index, but with each set of tile ids held as a bitset
+	return {dir:{bound:IdsToBitset(tile_ids) for (bound, tile_ids) in bound_index[dir].items()} for dir in DIRS}
+
+def IdsToBitset(tile_ids):
+	bitset = 0
+	for k in tile_ids:
+		bitset |= 1 << k
+	return bitset
+
+def BitsetToIds(bitset):
+	#bin() puts the most significant bit first, so read it backwards to get tile ids in ascending order
+	bits = bin(bitset)[:1:-1]
+	return [k for (k, bit) in enumerate(bits) if bit == '1']
+
+def GetCandidateBounds(tile_ids, dir, tile_map, memo):
+	#The distinct dir boundaries of the candidates tile_ids. memo keeps them by the id of the list,
+	#along with the list itself so that its id can't be reused by another one.
+	key = (id(tile_ids), dir)
+	if key not in memo:
+		memo[key] = (tile_ids, list(set(tile_map[k].boundaries[dir] for k in tile_ids)))
+	return memo[key][1]
+
+def GetCandidateSet(tile_ids, memo):
+	#The candidates tile_ids as a set, kept in memo like GetCandidateBounds does
+	if id(tile_ids) not in memo:
+		memo[id(tile_ids)] = (tile_ids, set(tile_ids))
+	return memo[id(tile_ids)][1]
+
+def HasViableTile(tile_id_set, exp_bound, bound_index):
+	#Whether GetViableTiles would find any tile of tile_id_set, without listing them
+	profiler = GetContext().profiler
+	if profiler != None:
+		profiler.Count('viable_tile_checks')
+	
+	cand_set = None
+	for dir in [TOP, RIGHT, BOT, LEFT]:
+		if exp_bound[dir] == []:
+			continue
+		elif len(exp_bound[dir]) == 1:
+			dir_set = bound_index[dir].get(exp_bound[dir][0], set())
+		else:
+			dir_set = set().union(*[bound_index[dir].get(bound, set()) for bound in exp_bound[dir]])
+		
+		cand_set = dir_set if cand_set == None else cand_set & dir_set
+		if len(cand_set) == 0:
+			return False
+	
+	return len(tile_id_set) > 0 if cand_set == None else not cand_set.isdisjoint(tile_id_set)
+
+def GetViableTiles(tile_ids, exp_bound, bound_index):
+	profiler = GetContext().profiler
+	if profiler != None:
+		profiler.Count('viable_tile_calls')
+		profiler.Count('viable_tiles_examined', len(tile_ids))
+	
+	cand_set = None
+	
+	for dir in [TOP, RIGHT, BOT, LEFT]:
+		if exp_bound[dir] == []:
+			continue #Either at the edge of the frame or boundaries is erroneous and anything goes.
+		elif len(exp_bound[dir]) == 1:
+			dir_set = bound_index[dir].get(exp_bound[dir][0], set())
+		else:
+			dir_set = set().union(*[bound_index[dir].get(bound, set()) for bound in exp_bound[dir]])
 		
-		if is_viable:
-			tile_cand_list.append(i)
+		cand_set = dir_set if cand_set == None else cand_set & dir_set
+		if len(cand_set) == 0:
+			return []
+	
+	if cand_set == None:
+		return list(tile_ids)
 	
-	return tile_cand_list
+	#Keep the order of tile_ids, so that candidates come out in the same order as a scan over tile_ids.
+	return [k for k in tile_ids if k in cand_set]
+
+def GetImageEdges(pixels):
+	#Slice the edges out of a height x width x channel array of pixel data
+	return {TOP:pixels[0].tobytes(), RIGHT:pixels[:, -1].tobytes(), BOT:pixels[-1].tobytes(), LEFT:pixels[:, 0].tobytes()}
 
 def GetTilesFromImages(im_list):
-	return dict(enumerate(map(Tile, im_list)))
+	edge_ids = {}
+	return {i:Tile(im, edge_ids) for (i, im) in enumerate(im_list)}
 
-def GetImagesFromPath(path, add_im):
+def GetImagesFromPath(path, add_im, cache_path = None, jobs = 1, low_memory = False):
+	#In low memory mode, each file is decoded to find its variants' edges and digests,
+	#but the variants are returned as LazyTileImages without pixels.
 	im_list = []
 	im_size = None
 	
@@ -413,7 +2159,34 @@ def GetImagesFromPath(path, add_im):
 		
 	files = glob.glob(os.path.join(path, '*'))
 	
-	print('Loading Images:')
+	cache = None
+	if cache_path != None:
+		cache = TileCache(cache_path, add_im)
+		files = [file for file in files if os.path.abspath(file) != os.path.abspath(cache_path)]
+	
+	#Gather whatever the cache has first, so that only the remaining files have to be decoded
+	cached_variants = {}
+	if cache != None:
+		for file in files:
+			if os.path.isfile(file):
+				cached_variants[file] = cache.GetVariants(file, low_memory)
+	load_files = [file for file in files if os.path.isfile(file) and cached_variants.get(file) == None]
+	
+	#Decode the files and create their variants in a process pool.
+	#map hands the results back in file order, so tile ids come out the same as when loading one file at a time.
+	#The pixel data is needed for the cache even in low memory mode, so that saving it doesn't decode the files again.
+	executor = None
+	leave_out_pixels = low_memory and cache == None
+	if jobs > 1 and len(load_files) > 1:
+		executor = concurrent.futures.ProcessPoolExecutor(max_workers = jobs)
+		results = executor.map(LoadImageVariants, load_files, itertools.repeat(add_im), itertools.repeat(leave_out_pixels),
+			chunksize = max(1, len(load_files) // (jobs * 8)))
+	else:
+		results = map(LoadImageVariants, load_files, itertools.repeat(add_im), itertools.repeat(leave_out_pixels))
+	
+	verbose = GetContext().verbose
+	if verbose:
+		print('Loading Images:')
 	files_loaded = 0
 	percent_done = 0.0
 	for file in files:
@@ -422,83 +2195,184 @@ def GetImagesFromPath(path, add_im):
 			files_loaded += 1
 			continue
 		
-		try:
-			im = Image.open(file)
-			im = im.convert('YCbCr') #Makes operations such as deblocking work.
-			
+		variants = cached_variants.get(file)
+		if variants == None:
+			(err, file_hash, size, pixel_data, variant_data) = next(results)
+			base = Image.frombytes(TILE_MODE, size, pixel_data) if pixel_data != None and not low_memory else None
+			variants = [LazyTileImage(file, size, transform, edges, digest, base) for (transform, edges, digest) in variant_data]
+			if err != None:
+				#Presumably the image files are resting in a directory with other non-image files.
+				Log(WARN, err)
+			elif cache != None:
+				cache.AddVariants(file, file_hash, variants, pixel_data if base == None else None)
+		
+		if variants != []:
 			if im_size == None:
-				im_size = im.size
-			elif im_size != im.size:
+				im_size = variants[0].size
+			elif im_size != variants[0].size:
 				#Restriction: All tiles must be of the same size
 				Log(ERR, 'Image from ' + file + ' does not have the same size as image from ' + files[0] + '.')
-				im.close()
-				for i in im_list:
-					i.close()
+				if executor != None:
+					executor.shutdown(cancel_futures = True)
+				CloseImages(variants)
+				CloseImages(im_list)
 				return []
-			
-			#To increase the number of tile combinations,
-			#Add additional images to the list which are just the same image but rotated and mirrored.
-			if add_im:
-				#TODO: It may be more efficient to determine the picture's symmetry and 
-				#  only create additional images that are non-identical.
-				degrees = [0, 180]
-				if im_size[0] == im_size[1]: #if image is square we can add more rotations without consequence
-					degrees += [90, 270]
-				
-				for degree in degrees:
-					new_im1 = im.rotate(degree)
-					new_im1.filename = file #Workaround for filename attribute error
-					im_list.append(new_im1)
-					
-					new_im2 = ImageOps.mirror(im.rotate(degree)) #ImageOps.mirror flips horizontally
-					new_im2.filename = file #Workaround for filename attribute error
-					im_list.append(new_im2)
-			else:
-				im_list.append(im)
-		except OSError as err:
-			#Presumably the image files are resting in a directory with other non-image files.
-			Log(WARN, str(err))
+		
+		im_list += variants
 	
 		files_loaded += 1
-		if (files_loaded / len(files))*100.0 >= percent_done + 10:
+		if verbose and (files_loaded / len(files))*100.0 >= percent_done + 10:
 			percent_done = ((files_loaded * 10) // len(files)) * 10.0
 			print('  ' + str(percent_done) + '% of images have been loaded.')
 			sys.stdout.flush()
 	
+	if executor != None:
+		executor.shutdown()
+	
+	if cache != None:
+		cache.Save()
+	
 	if add_im:
 		#Many of the images that we just added could be duplicates.
 		#Remove duplicate images to reduce run time of further operations in the future.
 		#Note: Normally would delete duplicates by having images be a set and avoid a function call, 
 		#but that won't work here, as each image contains some file object member.
-		print('  Deleting Duplicates')
-		sys.stdout.flush()
-		im_list = DeleteDuplicateImages(im_list)
+		if verbose:
+			print('  Deleting Duplicates')
+			sys.stdout.flush()
+		with ProfilePhase('dedup'):
+			im_list = DeleteDuplicateImages(im_list)
 	
 	if im_list == []:
 		Log(ERR, 'Could not find any image files in ' + path)
 	
 	return im_list
 
-def DeleteDuplicateImages(im_list):
-	indices_to_del = []
+def LoadImageVariants(file, add_im, low_memory = False):
+	#Decode a tile file and work out its variants, along with their edges and digests.
+	#The variants' images are never created: their edges are the file image's edges, reversed and swapped around
+	#by TransformEdges, and their digests and any symmetry come from transformed views of the file's pixel array.
+	#This runs in the worker processes of GetImagesFromPath, so it returns
+	#(error, file hash, size, pixel data, [(transform, edges, digest)]) with the raw pixel data of the file's image,
+	#and leaves logging to the caller. In low memory mode, the raw pixel data is left out.
+	try:
+		with open(file, 'rb') as f:
+			file_data = f.read()
+		im = Image.open(io.BytesIO(file_data))
+		im = im.convert(TILE_MODE)
+	except OSError as err:
+		return (str(err), None, None, None, [])
+	
+	pixels = np.asarray(im)
+	transforms = GetTransforms(im.size, add_im)
+	all_edges = [TransformEdges(GetImageEdges(pixels), transform) for transform in transforms]
 	
-	for i in range(len(im_list)):
-		for j in range(i + 1, len(im_list)):
-			if ImagesAreIdentical(im_list[i], im_list[j]):
-				#There is no difference between the images. Remove the ith image
-				indices_to_del.append(i)
+	variant_data = [(transforms[k], all_edges[k], GetPixelDigest(TransformPixels(pixels, transforms[k])))
+		for k in GetDistinctTransforms(pixels, transforms, all_edges)]
+	
+	pixel_data = im.tobytes() if not low_memory else None
+	return (None, GetFileHash(file_data), im.size, pixel_data, variant_data)
+
+def GetDistinctTransforms(pixels, transforms, all_edges):
+	#Returns the indices of the transforms which give distinct pictures of pixels, where all_edges are the edges of each one.
+	#Only the last of the transforms that give the same picture is kept, as DeleteDuplicateImages would.
+	#Pixels only need comparing when all four edges are the same.
+	indices = []
+	for (k, transform) in enumerate(transforms):
+		is_dup = False
+		for j in range(k + 1, len(transforms)):
+			if all_edges[k] == all_edges[j] and np.array_equal(TransformPixels(pixels, transform), TransformPixels(pixels, transforms[j])):
+				is_dup = True
 				break
+		
+		if not is_dup:
+			indices.append(k)
+	
+	return indices
+
+def GetTransforms(size, add_im):
+	transforms = [(0, False)]
 	
-	#Delete duplicates from highest index to lowest index to prevent out of bound errors.
-	for i in reversed(indices_to_del):
-		del im_list[i]
+	#To increase the number of tile combinations,
+	#Add additional images to the list which are just the same image but rotated and mirrored.
+	if add_im:
+		degrees = [0, 180]
+		if size[0] == size[1]: #if image is square we can add more rotations without consequence
+			degrees += [90, 270]
+		transforms = [(degree, mirrored) for degree in degrees for mirrored in [False, True]]
 	
-	return im_list
+	return transforms
+
+def TransformEdges(edges, transform):
+	#The edges of an image after TransformImage, from the edges of the image before it.
+	#Rotating counter-clockwise turns the right edge into the top edge, the reversed bottom edge into the right edge, and so on.
+	(degree, mirrored) = transform
+	for k in range(degree // 90):
+		edges = {TOP:edges[RIGHT], RIGHT:ReverseEdge(edges[BOT]), BOT:edges[LEFT], LEFT:ReverseEdge(edges[TOP])}
+	if mirrored:
+		edges = {TOP:ReverseEdge(edges[TOP]), RIGHT:edges[LEFT], BOT:ReverseEdge(edges[BOT]), LEFT:edges[RIGHT]}
+	return edges
+
+def ReverseEdge(edge):
+	return np.frombuffer(edge, dtype = np.uint8).reshape(-1, TILE_CHANNELS)[::-1].tobytes()
+
+def TransformPixels(pixels, transform):
+	#Same as TransformImage, but returns a view of a height x width x channel array of pixel data
+	(degree, mirrored) = transform
+	pixels = np.rot90(pixels, degree // 90)
+	if mirrored:
+		pixels = pixels[:, ::-1]
+	return pixels
+
+def TransformImage(im, transform):
+	#A transform is a (degree, mirrored) pair: rotate counter-clockwise by degree, then flip horizontally if mirrored.
+	(degree, mirrored) = transform
+	new_im = im.rotate(degree)
+	if mirrored:
+		new_im = ImageOps.mirror(new_im) #ImageOps.mirror flips horizontally
+	return new_im
+
+def GetFileHash(file_data):
+	return hashlib.blake2b(file_data, digest_size = 16).hexdigest()
+
+def DeleteDuplicateImages(im_list):
+	#Bucket the images by a hash of their pixel data, so that only images whose hashes collide get compared byte by byte.
+	#As before, when several images are identical the last one is kept.
+	buckets = {}
+	is_dup = [False] * len(im_list)
+	
+	for i in reversed(range(len(im_list))):
+		bucket = buckets.setdefault(GetImageDigest(im_list[i]), [])
+		if any(ImagesAreIdentical(im_list[i], im_list[j]) for j in bucket):
+			is_dup[i] = True
+		else:
+			bucket.append(i)
+	
+	return [im for (i, im) in enumerate(im_list) if not is_dup[i]]
+
+def GetImageDigest(im):
+	#Images loaded from the tile cache already carry their digest
+	if hasattr(im, 'digest'):
+		return im.digest
+	
+	digest = hashlib.blake2b(digest_size = 16)
+	digest.update((im.mode + str(im.size)).encode())
+	digest.update(im.tobytes())
+	return digest.digest()
+
+def GetPixelDigest(pixels):
+	#Same digest as GetImageDigest gives the TILE_MODE image of a height x width x channel array of pixel data
+	digest = hashlib.blake2b(digest_size = 16)
+	digest.update((TILE_MODE + str((pixels.shape[1], pixels.shape[0]))).encode())
+	digest.update(np.ascontiguousarray(pixels).tobytes())
+	return digest.digest()
 
 def ImagesAreIdentical(im1, im2):
-	NO_DIFF = (0,0,0,0)
-	pixels = ImageChops.difference(im1, im2).getdata()
-	return all(pixel == pixels[0] for pixel in pixels) and pixels[0] == NO_DIFF
+	if isinstance(im1, LazyTileImage) or isinstance(im2, LazyTileImage):
+		#Only transform or decode the pixels when the digests say the images are the same, to rule out a collision
+		if im1.mode != im2.mode or im1.size != im2.size or GetImageDigest(im1) != GetImageDigest(im2):
+			return False
+	return im1.mode == im2.mode and im1.size == im2.size and im1.tobytes() == im2.tobytes()
 
 def IsPosInt(x):
 	return type(x) == int and x > 0
@@ -533,55 +2407,291 @@ def CloseImages(im_list):
 	for im in im_list:
 		im.close()
 
-def Main():
-	global g_err_occurred
-	args = ParseCommandLineArgs()
+def CreatePicture(job, tile_map, bound_index, args, jobs = 1, verbose = True):
+	#Create the tile grid described by job, process it and save the resulting picture to job['out'].
+	#job has the same 'size', 'grid', 'speed_mode' and 'out' settings as the command line, plus a 'seed'.
+	#Returns whether the picture was saved.
+	atlas = None
+	if args.preview != None and tile_map != {}:
+		atlas = GetPreviewAtlas(tile_map, args.preview)
 	
-	SetupLogging(args.log)
+	if args.pipeline and os.path.splitext(job['out'])[1].lower() != DZI_EXT:
+		(tile_grid, frame_width, frame_height, saved) = SolveAndSaveTileGrid(job, tile_map, bound_index, args, jobs, verbose, atlas)
+	else:
+		(tile_grid, frame_width, frame_height) = SolveTileGrid(job, tile_map, bound_index, args, jobs, verbose)
+		
+		if verbose and not GetContext().err_occurred:
+			print('Processing has finished. Creating picture')
+			sys.stdout.flush()
+		saved = SavePictureFromTileGrid(tile_grid, tile_map, frame_width, frame_height, job['out'], args.stream, jobs, atlas)
+	
+	if args.save_grid:
+		with ProfilePhase('save'):
+			SaveSolvedGrid(job['out'] + GRID_EXT, tile_grid, tile_map)
 	
+	return saved
+
+def SavePictureFromTileGrid(tile_grid, tile_map, frame_width, frame_height, out_path, stream = False, jobs = 1, atlas = None):
+	#Returns whether the picture was saved
+	if os.path.splitext(out_path)[1].lower() == DZI_EXT:
+		#Rendering and saving are interleaved, so they can only be timed together
+		with ProfilePhase('save'):
+			return SaveDeepZoomPyramid(tile_grid, tile_map, frame_width, frame_height, out_path, jobs, atlas)
+	elif stream:
+		#Rendering and saving are interleaved, so they can only be timed together
+		with ProfilePhase('save'):
+			return SavePictureFromTileGridInBands(tile_grid, tile_map, frame_width, frame_height, out_path, atlas)
+	else:
+		with ProfilePhase('render'):
+			new_im = CreatePictureFromTileGrid(tile_grid, tile_map, frame_width, frame_height, atlas)
+		
+		if type(new_im) != Image.Image:
+			return False
+		with ProfilePhase('save'):
+			try:
+				new_im.save(out_path)
+			except (OSError, ValueError) as err:
+				Log(ERR, 'Failed to save picture to "' + out_path + '". Error message: "' + str(err) + '"')
+				return False
+		return True
+
+def ReplayPicture(grid_path, tile_map, out_path, stream = False, jobs = 1, atlas = None):
+	#Create the picture of a solved tile grid saved by SaveSolvedGrid, without solving anything
+	with ProfilePhase('grid_build'):
+		(tile_grid, frame_width, frame_height) = LoadSolvedGrid(grid_path, tile_map)
+	
+	SavePictureFromTileGrid(tile_grid, tile_map, frame_width, frame_height, out_path, stream, jobs, atlas)
+
+def SolveTileGrid(job, tile_map, bound_index, args, jobs = 1, verbose = True):
+	#Create the tile grid described by job and process it. Returns the processed grid along with its width and height.
+	(tile_grid, frame_width, frame_height) = BuildTileGrid(job, tile_map, args, verbose)
+	
+	with ProfilePhase('process'):
+		tile_grid = ProcessTileGridWithClasses(tile_grid, tile_map, bound_index, frame_width, frame_height, job['speed_mode'], args, jobs)
+	
+	return (tile_grid, frame_width, frame_height)
+
+def SolveAndSaveTileGrid(job, tile_map, bound_index, args, jobs = 1, verbose = True, atlas = None):
+	#Same as SolveTileGrid followed by streaming the picture to job['out'], except that each row of tiles
+	#is rendered and encoded on another thread as soon as it is solved, so that solving and encoding overlap.
+	#Also returns whether the picture was saved.
+	(tile_grid, frame_width, frame_height) = BuildTileGrid(job, tile_map, args, verbose)
+	
+	pipeline = None
+	if tile_map != {} and tile_grid != [] and frame_width > 0 and frame_height > 0:
+		if atlas == None:
+			atlas = TileAtlas(tile_map)
+		writer = OpenBandWriter(job['out'], atlas.tile_size[0]*frame_width, atlas.tile_size[1]*frame_height)
+		if writer != None:
+			pipeline = TileRowPipeline(writer, atlas)
+	
+	finished = False
+	saved = False
+	try:
+		with ProfilePhase('process'):
+			row_callback = pipeline.RowDone if pipeline != None else None
+			tile_grid = ProcessTileGridWithClasses(tile_grid, tile_map, bound_index, frame_width, frame_height, job['speed_mode'], args, jobs, row_callback)
+		
+		if pipeline != None:
+			if verbose and not GetContext().err_occurred:
+				print('Processing has finished. Finishing picture')
+				sys.stdout.flush()
+			
+			#Most rows are rendered and encoded during processing, so this only times the rows left over
+			with ProfilePhase('save'):
+				saved = pipeline.Finish(tile_grid)
+		finished = True
+	finally:
+		#Even when interrupted, the writer thread has to be told to stop and the unfinished picture removed
+		if pipeline != None and not finished:
+			pipeline.Abort()
+	
+	return (tile_grid, frame_width, frame_height, saved)
+
+def BuildTileGrid(job, tile_map, args, verbose = True):
+	#Create the unprocessed tile grid described by job. Returns the grid along with its width and height.
+	#Also seeds the random choice of tiles with the job's seed, if it has one.
+	context = GetContext()
 	(frame_width, frame_height) = (-1, -1)
 	tile_grid = []
 	
-	im_list = GetImagesFromPath(args.path, args.add_im)
-	tile_map = GetTilesFromImages(im_list)
-	if not g_err_occurred:
-		print('Tiles have been created.\nCreating Tile Grid.')
-		sys.stdout.flush()
+	if job['seed'] != None:
+		context.random = random.Random(job['seed'])
 	
-	if args.grid == '':
-		(frame_width, frame_height) = Get2TupleFromStr(args.size)
-		tile_grid = ConstructTileGrid(tile_map, frame_width, frame_height)
-	else:
-		grid_path = os.path.join(args.path, args.grid)
-		(tile_grid, frame_width, frame_height) = GetTileGridFromFile(grid_path, tile_map)
+	with ProfilePhase('grid_build'):
+		if job['grid'] == '':
+			(frame_width, frame_height) = Get2TupleFromStr(job['size'])
+			tile_grid = ConstructTileGrid(tile_map, frame_width, frame_height)
+		else:
+			grid_path = os.path.join(args.path, job['grid'])
+			(tile_grid, frame_width, frame_height) = GetTileGridFromFile(grid_path, tile_map)
 	
-	if not g_err_occurred:
+	if verbose and not context.err_occurred:
 		print('Created Tile Grid.\nProcessing Tile Grid.')
 		sys.stdout.flush()
 	
-	if args.speed_mode == NORMAL:
-		tile_grid = ProcessTileGrid(tile_grid, tile_map, frame_width, frame_height)
-	elif args.speed_mode == FAST:
-		tile_grid = FastProcessTileGrid(tile_grid, tile_map, frame_width, frame_height)
-	elif args.speed_mode == NO_COMPARE:
-		tile_grid = ProcessTileGridNoCompare(tile_grid, tile_map, frame_width, frame_height)
+	return (tile_grid, frame_width, frame_height)
+
+def ProcessTileGridWithClasses(tile_grid, tile_map, bound_index, frame_width, frame_height, speed_mode, args, jobs = 1, row_callback = None):
+	if args.classes:
+		(class_map, tile_class) = GetTileClasses(tile_map, tile_grid)
+	if args.classes and len(class_map) < len(tile_map) and tile_grid != []:
+		#Solve over classes of tiles with the same boundaries, then pick a tile of each class.
+		#When no tiles share their boundaries, there is nothing to gain, so solve over the tiles as they are.
+		class_grid = GetClassGrid(tile_grid, tile_class)
+		expander = ClassRowExpander(tile_grid, tile_class, random.Random(GetContext().random.getrandbits(64)), row_callback)
+		class_grid = ProcessTileGridWithArgs(class_grid, class_map, GetBoundaryIndex(class_map), frame_width, frame_height, speed_mode, args, jobs, expander.RowDone)
+		return expander.Finish(class_grid)
+	
+	return ProcessTileGridWithArgs(tile_grid, tile_map, bound_index, frame_width, frame_height, speed_mode, args, jobs, row_callback)
+
+def ProcessTileGridWithArgs(tile_grid, tile_map, bound_index, frame_width, frame_height, speed_mode, args, jobs = 1, row_callback = None):
+	#Strips are solved out of order, so they never call row_callback
+	if args.strips > 1:
+		return StripProcessTileGrid(tile_grid, tile_map, bound_index, frame_width, frame_height, speed_mode, args, jobs)
+	return ProcessTileGridWithMode(tile_grid, tile_map, bound_index, frame_width, frame_height, speed_mode, args.backtrack_budget, row_callback)
+
+def GetBatchJobs(args):
+	#Returns the list of pictures to create, or None if only a single picture was asked for
+	base_seed = args.seed
+	if base_seed == None and (args.count > 1 or args.manifest != ''):
+		#Pick a seed anyway, so that the batch can be reproduced
+		base_seed = GetContext().random.randrange(2**32)
+		print('Using seed ' + str(base_seed))
+	
+	if args.manifest != '':
+		try:
+			with open(args.manifest) as f:
+				manifest = yaml.load(f, Loader = YAML_LOADER)
+		except Exception as err:
+			Log(ERR, 'Failed to get manifest from path "' + args.manifest + '". Error message: "' + str(err) + '"')
+			return []
+		if type(manifest) != list:
+			Log(ERR, 'Manifest "' + args.manifest + '" is not a list of pictures')
+			return []
+		
+		batch = []
+		for (k, entry) in enumerate(manifest):
+			if type(entry) != dict:
+				Log(ERR, 'Manifest entry ' + str(k) + ' is not a map of settings')
+				continue
+			elif 'out' not in entry:
+				Log(ERR, 'Manifest entry ' + str(k) + ' does not say where to save its picture')
+				continue
+			
+			#An entry which sets its size but no grid is sized instead of following the command line's grid
+			grid = entry.get('grid', args.grid if 'size' not in entry else '')
+			batch.append({'size':str(entry.get('size', args.size)), 'grid':grid, 'out':entry['out'],
+				'speed_mode':entry.get('speed_mode', args.speed_mode), 'seed':entry.get('seed', base_seed + k)})
+		return batch
+	elif args.count > 1:
+		#Number the outputs with the pattern in out, or just before the extension if there isn't one
+		out_pattern = args.out
+		if '{}' not in out_pattern:
+			(root, ext) = os.path.splitext(out_pattern)
+			out_pattern = root + '_{}' + ext
+		
+		return [{'size':args.size, 'grid':args.grid, 'out':out_pattern.format(k), 'speed_mode':args.speed_mode, 'seed':base_seed + k}
+			for k in range(args.count)]
+	
+	return None
+
+def CreateBatchPictures(batch, tile_map, bound_index, args, jobs):
+	print('Creating ' + str(len(batch)) + ' pictures.')
+	sys.stdout.flush()
+	
+	#Each worker gets its own copy of the tile set once, instead of once per picture
+	executor = None
+	if jobs > 1 and len(batch) > 1:
+		executor = concurrent.futures.ProcessPoolExecutor(max_workers = jobs, initializer = SetupWorker, initargs = (tile_map, bound_index, args))
+		results = executor.map(CreateBatchPicture, batch)
 	else:
-		Log(ERR, 'speed_mode "' + str(args.speed_mode) + '" does not exist')
-		tile_grid = []
+		results = map(functools.partial(CreateBatchPicture, tile_set = (tile_map, bound_index, args)), batch)
+	
+	for (job, (job_err_occurred, saved)) in zip(batch, results):
+		if not saved:
+			SetErrOccurred(True)
+			print('  Failed to create ' + job['out'] + '.')
+		elif job_err_occurred:
+			SetErrOccurred(True)
+			print('  Created ' + job['out'] + ' with errors.')
+		else:
+			print('  Created ' + job['out'])
+		sys.stdout.flush()
+	
+	if executor != None:
+		executor.shutdown()
+
+def SetupWorker(tile_map, bound_index, args):
+	#Only runs in worker processes
+	global g_worker_tile_set
+	g_worker_tile_set = (tile_map, bound_index, args)
+	
+	#Worker processes can't share the log file or the profiler, so they only report errors to stdout
+	g_context.set(RunContext(verbose = False))
+
+def CreateBatchPicture(job, tile_set = None):
+	#Returns whether an error occurred while creating this picture, and whether it was saved.
+	#Takes the tile set from SetupWorker unless it is given.
+	(tile_map, bound_index, args) = tile_set if tile_set != None else g_worker_tile_set
+	
+	with UseContext(GetContext().Fork(job['seed'])) as context:
+		saved = CreatePicture(job, tile_map, bound_index, args, verbose = False)
+	return (context.err_occurred, saved)
+
+def Main():
+	args = ParseCommandLineArgs()
+	context = GetContext()
+	
+	SetupLogging(args.log)
+	SetupProfiling(args.profile, args.profile_phase, args.profile_memory)
+	
+	cache_path = None
+	if args.cache == '':
+		cache_path = os.path.join(args.path, CACHE_NAME)
+	elif args.cache != None:
+		cache_path = args.cache
+	
+	jobs = args.jobs if args.jobs > 0 else os.cpu_count()
 	
-	if not g_err_occurred:
-		print('Processing has finished. Creating picture')
+	if args.preview != None and args.preview <= 0:
+		Log(ERR, 'Preview scale must be greater than 0, but is ' + str(args.preview) + '. Creating the picture at full size instead')
+		args.preview = None
+	
+	tile_set = TileSet(args.path, args.add_im, cache_path, jobs, args.low_memory, context)
+	(tile_map, bound_index) = (tile_set.tile_map, tile_set.bound_index)
+	if not context.err_occurred:
+		print('Tiles have been created.')
 		sys.stdout.flush()
-	new_im = CreatePictureFromTileGrid(tile_grid, tile_map, frame_width, frame_height)
 	
-	if type(new_im) == Image.Image:
-		new_im.save(args.out)
+	batch = GetBatchJobs(args)
+	if args.replay != '':
+		if not context.err_occurred:
+			print('Creating picture from ' + args.replay)
+			sys.stdout.flush()
+		
+		atlas = None
+		if args.preview != None and tile_map != {}:
+			atlas = GetPreviewAtlas(tile_map, args.preview)
+		ReplayPicture(args.replay, tile_map, args.out, args.stream or args.pipeline, jobs, atlas)
+	elif batch == None:
+		if not context.err_occurred:
+			print('Creating Tile Grid.')
+			sys.stdout.flush()
+		
+		job = {'size':args.size, 'grid':args.grid, 'out':args.out, 'speed_mode':args.speed_mode, 'seed':args.seed}
+		CreatePicture(job, tile_map, bound_index, args, jobs)
+	else:
+		CreateBatchPictures(batch, tile_map, bound_index, args, jobs)
+	
+	if context.profiler != None:
+		context.profiler.Save(args.out.replace('{}', '') + '.profile.json')
 	
-	CloseImages(im_list)
+	tile_set.Close()
 	CloseLog()
 	
-	if not g_err_occurred:
+	if not context.err_occurred:
 		print('DONE')
 	
 if __name__ == "__main__":
-	Main()
\ No newline at end of file
+	Main()
@@ -0,0 +1,609 @@
+from PIL import Image
+import os
+import os.path
+import itertools
+import json
+import numpy as np
+import pytest
+import threading
+import CreatePictureFromTiles as cpft
+import BenchmarkCreatePictureFromTiles as bench
+
+GRAY = (128, 128, 128)
+RED = (200, 0, 0)
+BLUE = (0, 0, 200)
+
+def WriteTile(path, name, top, bot, left, right, seed, size = 8):
+	#A tile with a random interior, a single colour along each edge and gray corners,
+	#so that any two tiles whose touching edges have the same colour fit next to each other
+	pixels = np.random.default_rng(seed).integers(0, 256, (size, size, 3), dtype = np.uint8)
+	pixels[0] = top
+	pixels[-1] = bot
+	pixels[:, 0] = left
+	pixels[:, -1] = right
+	pixels[[0, 0, -1, -1], [0, -1, 0, -1]] = GRAY
+	Image.fromarray(pixels, 'RGB').save(os.path.join(path, name))
+
+def WriteYaml(path, name, id_map, grid):
+	with open(os.path.join(path, name), 'w') as f:
+		f.write('id:\n')
+		for (id, im_list) in id_map.items():
+			f.write('  ' + str(id) + ': [' + ', '.join(im_list) + ']\n')
+		if type(grid) == str:
+			f.write('grid: ' + grid + '\n')
+		else:
+			f.write('grid:\n')
+			for row in grid:
+				f.write('  - [' + ', '.join(str(id) for id in row) + ']\n')
+
+@pytest.fixture
+def class_tile_set(tmp_path):
+	#Ten tiles with a red top edge and one with a blue top edge, which all fit next to each other in a single row
+	for k in range(10):
+		WriteTile(tmp_path, 'red' + str(k) + '.png', RED, GRAY, GRAY, GRAY, k)
+	WriteTile(tmp_path, 'blue0.png', BLUE, GRAY, GRAY, GRAY, 10)
+	return tmp_path
+
+def test_classes_pick_tiles_as_often_as_without_classes_on_a_restricted_grid(class_tile_set):
+	#A grid space which allows one tile of the ten tile class and the one tile class should pick each half of the time
+	width = 600
+	WriteYaml(class_tile_set, 'grid.yaml', {1:['red0.png', 'blue0.png']}, [[1]*width])
+	tile_set = cpft.TileSet(str(class_tile_set), add_im = False)
+
+	for classes in [True, False]:
+		tile_grid = tile_set.Generate(grid = 'grid.yaml', speed_mode = cpft.FAST, seed = 3, return_grid = True, classes = classes)
+		names = [os.path.basename(tile_set.tile_map[k].filename) for k in tile_grid[0]]
+		assert set(names) == {'red0.png', 'blue0.png'}
+		assert 0.4 < names.count('blue0.png') / width < 0.6
+
+	tile_set.Close()
+
+def test_classes_weight_unrestricted_tiles_evenly(class_tile_set):
+	width = 1100
+	tile_set = cpft.TileSet(str(class_tile_set), add_im = False)
+	tile_grid = tile_set.Generate(size = (width, 1), speed_mode = cpft.FAST, seed = 5, return_grid = True)
+	names = [os.path.basename(tile_set.tile_map[k].filename) for k in tile_grid[0]]
+
+	assert 0.05 < names.count('blue0.png') / width < 0.13
+	tile_set.Close()
+
+@pytest.fixture
+def wang_tile_set(tmp_path):
+	#Every combination of two edge colours, so that any grid can be completed in every speed mode.
+	#A few combinations have a second tile, so that there are classes of tiles with the same boundaries.
+	path = tmp_path / 'tiles'
+	path.mkdir()
+	combos = list(itertools.product([GRAY, RED], repeat = 4))
+	for (k, combo) in enumerate(combos):
+		WriteTile(path, 'tile' + str(k) + '.png', *combo, k)
+	for (k, combo) in enumerate(combos[:4]):
+		WriteTile(path, 'extra' + str(k) + '.png', *combo, len(combos) + k)
+	return path
+
+@pytest.mark.parametrize('ext', ['.png', '.ppm'])
+def test_streamed_picture_matches_rendered_picture(wang_tile_set, tmp_path, ext):
+	tile_set = cpft.TileSet(str(wang_tile_set))
+	tile_grid = tile_set.Generate(size = (7, 5), seed = 1, return_grid = True)
+	out_path = str(tmp_path / ('out' + ext))
+
+	assert cpft.SavePictureFromTileGridInBands(tile_grid, tile_set.tile_map, 7, 5, out_path)
+	expected = cpft.CreatePictureFromTileGrid(tile_grid, tile_set.tile_map, 7, 5)
+	with Image.open(out_path) as im:
+		assert im.tobytes() == expected.tobytes()
+	tile_set.Close()
+
+def test_interrupted_stream_leaves_no_picture(tmp_path):
+	out_path = str(tmp_path / 'out.png')
+	with pytest.raises(KeyboardInterrupt):
+		with cpft.OpenBandWriter(out_path, 4, 4) as writer:
+			writer.WriteBand(Image.new('RGB', (4, 2)))
+			raise KeyboardInterrupt()
+
+	assert not os.path.exists(out_path)
+
+def CreatePictureWithArgs(tile_path, out_path, argv):
+	args = cpft.ParseCommandLineArgs(['--path', str(tile_path), '--out', str(out_path), '--seed', '4'] + argv)
+	tile_set = cpft.TileSet(args.path, args.add_im)
+	with cpft.UseContext(cpft.RunContext(verbose = False)) as context:
+		job = {'size':args.size, 'grid':args.grid, 'out':args.out, 'speed_mode':args.speed_mode, 'seed':args.seed}
+		cpft.CreatePicture(job, tile_set.tile_map, tile_set.bound_index, args, verbose = False)
+	tile_set.Close()
+	return context
+
+@pytest.mark.parametrize('speed_mode', [cpft.NORMAL, cpft.FAST, cpft.NO_COMPARE, cpft.BACKTRACK])
+@pytest.mark.parametrize('classes', ['--classes', '--no_classes'])
+def test_pipelined_picture_matches_streamed_picture(wang_tile_set, tmp_path, speed_mode, classes):
+	argv = ['--size', '9,40', '--speed_mode', str(speed_mode), classes]
+	CreatePictureWithArgs(wang_tile_set, tmp_path / 'stream.png', argv + ['--stream'])
+	CreatePictureWithArgs(wang_tile_set, tmp_path / 'pipeline.png', argv + ['--pipeline'])
+
+	with Image.open(tmp_path / 'stream.png') as stream_im, Image.open(tmp_path / 'pipeline.png') as pipeline_im:
+		assert stream_im.tobytes() == pipeline_im.tobytes()
+
+def test_interrupted_pipeline_stops_its_writer(wang_tile_set, tmp_path, monkeypatch):
+	def InterruptedProcess(tile_grid, tile_map, bound_index, frame_width, frame_height, speed_mode, args, jobs = 1, row_callback = None):
+		for i in range(3):
+			row_callback(i, [0]*frame_width)
+		raise KeyboardInterrupt()
+	monkeypatch.setattr(cpft, 'ProcessTileGridWithClasses', InterruptedProcess)
+	threads = threading.active_count()
+
+	with pytest.raises(KeyboardInterrupt):
+		CreatePictureWithArgs(wang_tile_set, tmp_path / 'out.png', ['--size', '9,40', '--pipeline'])
+	assert threading.active_count() == threads
+	assert not os.path.exists(tmp_path / 'out.png')
+
+def test_pipeline_keeps_solving_when_rendering_fails(wang_tile_set, tmp_path, monkeypatch):
+	#More rows than the queue holds, so that a writer which stopped taking rows would leave the solver waiting
+	def FailedRender(self, grid_array):
+		raise ValueError('render failed')
+	monkeypatch.setattr(cpft.TileAtlas, 'Render', FailedRender)
+
+	context = CreatePictureWithArgs(wang_tile_set, tmp_path / 'out.png', ['--size', '9,40', '--pipeline'])
+	assert context.err_occurred
+	assert not os.path.exists(tmp_path / 'out.png')
+
+def CountMismatches(tile_grid, tile_map):
+	#Number of pairs of neighbouring tiles whose boundaries don't match. Black grid spaces match anything.
+	mismatches = 0
+	for i in range(len(tile_grid)):
+		for j in range(len(tile_grid[i])):
+			if tile_grid[i][j] == []:
+				continue
+			if j + 1 < len(tile_grid[i]) and tile_grid[i][j + 1] != []:
+				mismatches += tile_map[tile_grid[i][j]].boundaries[cpft.RIGHT] != tile_map[tile_grid[i][j + 1]].boundaries[cpft.LEFT]
+			if i + 1 < len(tile_grid) and tile_grid[i + 1][j] != []:
+				mismatches += tile_map[tile_grid[i][j]].boundaries[cpft.BOT] != tile_map[tile_grid[i + 1][j]].boundaries[cpft.TOP]
+	return mismatches
+
+@pytest.mark.parametrize('colors, density, seed', [(3, 0.2, 1), (3, 0.2, 2), (2, 0.15, 0)])
+def test_backtracking_that_gives_up_leaves_no_mismatched_tiles(tmp_path, colors, density, seed):
+	#Tile sets which speed mode 3 can't complete within a budget of 2 backtracks
+	bench.CreateSyntheticTileSet(str(tmp_path), 6, colors, bench.SYM_NONE, density, 81, 2)
+	tile_set = cpft.TileSet(str(tmp_path), add_im = False)
+	context = cpft.RunContext(verbose = False)
+
+	tile_grid = tile_set.Generate((16, 16), speed_mode = cpft.BACKTRACK, seed = seed, return_grid = True,
+		backtrack_budget = 2, classes = False, context = context)
+	assert context.err_occurred
+	assert CountMismatches(tile_grid, tile_set.tile_map) == 0
+	tile_set.Close()
+
+def test_pruning_stops_at_the_first_grid_space_left_without_candidates(wang_tile_set):
+	#The first grid space only allows tiles with a red right edge and the second only tiles with a gray left edge,
+	#so neither has candidates that fit. Only one of them should be emptied before pruning stops.
+	combos = list(itertools.product([GRAY, RED], repeat = 4))
+	red_right = ['tile' + str(k) + '.png' for (k, combo) in enumerate(combos) if combo[3] == RED]
+	gray_left = ['tile' + str(k) + '.png' for (k, combo) in enumerate(combos) if combo[2] == GRAY]
+	WriteYaml(wang_tile_set, 'grid.yaml', {1:red_right, 2:gray_left, 3:['tile' + str(k) + '.png' for k in range(len(combos))]}, [[1, 2, 3, 3]])
+	tile_set = cpft.TileSet(str(wang_tile_set), add_im = False)
+
+	with cpft.UseContext(cpft.RunContext(verbose = False)) as context:
+		(tile_grid, frame_width, frame_height) = cpft.GetTileGridFromFile(str(wang_tile_set / 'grid.yaml'), tile_set.tile_map)
+		tile_grid = cpft.PruneTileGrid(tile_grid, tile_set.tile_map, tile_set.bound_index, frame_width, frame_height)
+	assert context.err_occurred
+	assert tile_grid[0].count([]) == 1
+	tile_set.Close()
+
+@pytest.mark.parametrize('transform', [(degree, mirrored) for degree in [0, 90, 180, 270] for mirrored in [False, True]])
+def test_transformed_pixels_and_edges_match_pil(transform):
+	pixels = np.random.default_rng(0).integers(0, 256, (6, 6, 3), dtype = np.uint8)
+	im = Image.fromarray(pixels, 'RGB').convert(cpft.TILE_MODE)
+	pixels = np.asarray(im)
+	expected = np.asarray(cpft.TransformImage(im, transform))
+
+	assert np.array_equal(cpft.TransformPixels(pixels, transform), expected)
+	assert cpft.TransformEdges(cpft.GetImageEdges(pixels), transform) == cpft.GetImageEdges(expected)
+	assert cpft.GetPixelDigest(cpft.TransformPixels(pixels, transform)) == cpft.GetImageDigest(cpft.TransformImage(im, transform))
+
+def test_lazy_images_with_the_same_digest_are_compared_byte_by_byte(wang_tile_set):
+	tile_set = cpft.TileSet(str(wang_tile_set), add_im = False)
+	(im1, im2) = [tile_set.tile_map[k].im for k in range(2)]
+	assert isinstance(im1, cpft.LazyTileImage)
+
+	#A digest collision between two different tiles
+	im2.digest = im1.digest
+	assert not cpft.ImagesAreIdentical(im1, im2)
+	assert cpft.ImagesAreIdentical(im1, im1)
+	tile_set.Close()
+
+@pytest.mark.parametrize('preview', [0, -0.5])
+def test_tile_set_creates_full_size_picture_for_invalid_preview(wang_tile_set, preview):
+	tile_set = cpft.TileSet(str(wang_tile_set))
+	context = cpft.RunContext(verbose = False)
+	im = tile_set.Generate(size = (3, 2), seed = 1, context = context, preview = preview)
+
+	assert context.err_occurred
+	assert im.size == (3*8, 2*8)
+	tile_set.Close()
+
+def test_preview_is_scaled_down(wang_tile_set):
+	tile_set = cpft.TileSet(str(wang_tile_set))
+	context = cpft.RunContext(verbose = False)
+	im = tile_set.Generate(size = (3, 2), seed = 1, context = context, preview = 0.5)
+
+	assert not context.err_occurred
+	assert im.size == (3*4, 2*4)
+	tile_set.Close()
+
+def test_rendered_picture_matches_pasted_tiles(wang_tile_set):
+	tile_set = cpft.TileSet(str(wang_tile_set))
+	tile_grid = tile_set.Generate(size = (5, 3), seed = 2, return_grid = True)
+	tile_grid[1][2] = []
+
+	expected = Image.new('RGB', (5*8, 3*8))
+	for (i, row) in enumerate(tile_grid):
+		for (j, tile_id) in enumerate(row):
+			if tile_id != []:
+				tile_im = tile_set.tile_map[tile_id].im
+				if isinstance(tile_im, cpft.LazyTileImage):
+					tile_im = tile_im.Load()
+				expected.paste(tile_im.convert('RGB'), (j*8, i*8))
+	assert cpft.CreatePictureFromTileGrid(tile_grid, tile_set.tile_map, 5, 3).tobytes() == expected.tobytes()
+	tile_set.Close()
+
+def test_strips_connect_their_seams(tmp_path):
+	#A tile set whose seam rows don't fit each other when they are chosen on their own
+	bench.CreateSyntheticTileSet(str(tmp_path), 6, 2, bench.SYM_NONE, 0.4, 81, 2)
+	tile_set = cpft.TileSet(str(tmp_path), add_im = False)
+
+	for seed in range(3):
+		context = cpft.RunContext(verbose = False)
+		tile_grid = tile_set.Generate((12, 24), speed_mode = cpft.BACKTRACK, seed = seed, return_grid = True,
+			strips = 6, classes = False, context = context)
+		assert not context.err_occurred
+		assert CountMismatches(tile_grid, tile_set.tile_map) == 0
+	tile_set.Close()
+
+def test_strip_workers_stay_quiet(wang_tile_set, capfd):
+	tile_set = cpft.TileSet(str(wang_tile_set), add_im = False)
+	capfd.readouterr()
+	context = cpft.RunContext(verbose = False)
+	tile_grid = tile_set.Generate((6, 12), seed = 1, return_grid = True, strips = 3, jobs = 2, context = context)
+
+	assert not context.err_occurred
+	assert CountMismatches(tile_grid, tile_set.tile_map) == 0
+	assert capfd.readouterr().out == ''
+	tile_set.Close()
+
+@pytest.mark.parametrize('manifest, outs', [
+	('- out: a.png\n- b.png\n- [c.png]\n- size: 2,2\n', ['a.png']),
+	('out: a.png\n', []),
+	('a.png\n', [])])
+def test_batch_skips_malformed_manifest_entries(tmp_path, manifest, outs):
+	with open(tmp_path / 'manifest.yaml', 'w') as f:
+		f.write(manifest)
+	args = cpft.ParseCommandLineArgs(['--manifest', str(tmp_path / 'manifest.yaml'), '--seed', '1'])
+
+	with cpft.UseContext(cpft.RunContext(verbose = False)) as context:
+		batch = cpft.GetBatchJobs(args)
+	assert context.err_occurred
+	assert [job['out'] for job in batch] == outs
+
+@pytest.mark.parametrize('dtype', [np.int64, np.float64])
+def test_grid_file_reads_npy_grid_ids(wang_tile_set, dtype):
+	np.save(wang_tile_set / 'grid.npy', np.array([[1, 2], [2, 1]], dtype = dtype))
+	WriteYaml(wang_tile_set, 'grid.yaml', {1:['tile0.png'], 2.0:['tile1.png']}, 'grid.npy')
+	tile_set = cpft.TileSet(str(wang_tile_set), add_im = False)
+	(name0, name1) = [[k for (k, tile) in tile_set.tile_map.items() if os.path.basename(tile.filename) == name] for name in ['tile0.png', 'tile1.png']]
+
+	with cpft.UseContext(cpft.RunContext(verbose = False)) as context:
+		(tile_grid, frame_width, frame_height) = cpft.GetTileGridFromFile(str(wang_tile_set / 'grid.yaml'), tile_set.tile_map)
+	assert not context.err_occurred
+	assert tile_grid == [[name0, name1], [name1, name0]]
+	tile_set.Close()
+
+def test_grid_file_rejects_id_without_tile_list(wang_tile_set):
+	with open(wang_tile_set / 'grid.yaml', 'w') as f:
+		f.write('id:\n  1: tile0.png\ngrid:\n  - [1, 1]\n')
+	tile_set = cpft.TileSet(str(wang_tile_set), add_im = False)
+
+	with cpft.UseContext(cpft.RunContext(verbose = False)) as context:
+		assert cpft.GetTileGridFromFile(str(wang_tile_set / 'grid.yaml'), tile_set.tile_map) == ([], -1, -1)
+	assert context.err_occurred
+	tile_set.Close()
+
+def test_solved_grid_round_trip(wang_tile_set, tmp_path):
+	tile_set = cpft.TileSet(str(wang_tile_set))
+	tile_grid = tile_set.Generate(size = (6, 4), seed = 3, return_grid = True)
+	tile_grid[2][3] = []
+	grid_path = str(tmp_path / ('out' + cpft.GRID_EXT))
+
+	with cpft.UseContext(cpft.RunContext(verbose = False)) as context:
+		cpft.SaveSolvedGrid(grid_path, tile_grid, tile_set.tile_map)
+		assert cpft.LoadSolvedGrid(grid_path, tile_set.tile_map) == (tile_grid, 6, 4)
+	assert not context.err_occurred
+
+	expected = cpft.CreatePictureFromTileGrid(tile_grid, tile_set.tile_map, 6, 4)
+	assert tile_set.Replay(grid_path).tobytes() == expected.tobytes()
+	tile_set.Close()
+
+def BlockAverage(pixels):
+	#Each pixel of the level below, the rounded average of a 2x2 block of pixels, in which a missing last row or column
+	#is taken from the one before it
+	(height, width) = pixels.shape[:2]
+	below = np.zeros(((height + 1) // 2, (width + 1) // 2, 3), dtype = np.uint8)
+	for y in range(below.shape[0]):
+		for x in range(below.shape[1]):
+			block = [pixels[min(2*y + dy, height - 1), min(2*x + dx, width - 1)].astype(int) for dy in range(2) for dx in range(2)]
+			below[y, x] = (sum(block) + 2) // 4
+	return below
+
+@pytest.mark.parametrize('jobs', [1, 3])
+def test_deep_zoom_levels_are_block_averages(wang_tile_set, tmp_path, monkeypatch, jobs):
+	#Small pyramid tiles, so that each level is cut into several of them
+	monkeypatch.setattr(cpft, 'DZI_TILE_SIZE', 16)
+	tile_set = cpft.TileSet(str(wang_tile_set))
+	tile_grid = tile_set.Generate(size = (7, 5), seed = 2, return_grid = True)
+	out_path = str(tmp_path / ('out' + cpft.DZI_EXT))
+
+	with cpft.UseContext(cpft.RunContext(verbose = False)) as context:
+		assert cpft.SaveDeepZoomPyramid(tile_grid, tile_set.tile_map, 7, 5, out_path, jobs)
+	assert not context.err_occurred
+
+	level = np.asarray(cpft.CreatePictureFromTileGrid(tile_grid, tile_set.tile_map, 7, 5))
+	pyramid = cpft.DeepZoomPyramid(out_path, 7*8, 5*8)
+	for level_index in range(pyramid.max_level, -1, -1):
+		assert pyramid.GetLevelSize(level_index) == (level.shape[1], level.shape[0])
+		for (col, row, (left, top, right, bottom)) in pyramid.GetTileBoxes(level_index):
+			with Image.open(pyramid.GetTilePath(level_index, col, row)) as im:
+				assert np.array_equal(np.asarray(im), level[top:bottom, left:right])
+		level = BlockAverage(level)
+	assert level.shape[:2] == (1, 1)
+	tile_set.Close()
+
+def test_strips_in_several_threads_keep_their_tile_sets_apart(tmp_path):
+	#Two tile sets with different numbers of tiles, so that mixing them up picks tile ids the other set doesn't have
+	paths = []
+	for (name, extra) in [('a', 0), ('b', 4)]:
+		path = tmp_path / name
+		path.mkdir()
+		combos = list(itertools.product([GRAY, RED], repeat = 4))
+		for (k, combo) in enumerate(combos + combos[:extra]):
+			WriteTile(path, 'tile' + str(k) + '.png', *combo, k)
+		paths.append(path)
+	tile_sets = [cpft.TileSet(str(path), add_im = False) for path in paths]
+
+	results = [None] * len(tile_sets)
+	def Generate(k):
+		context = cpft.RunContext(verbose = False)
+		tile_grids = [tile_sets[k].Generate((8, 16), speed_mode = cpft.FAST, seed = seed, return_grid = True, strips = 3, context = context)
+			for seed in range(20)]
+		results[k] = (context.err_occurred, sum(CountMismatches(tile_grid, tile_sets[k].tile_map) for tile_grid in tile_grids))
+	threads = [threading.Thread(target = Generate, args = (k,)) for k in range(len(tile_sets))]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+
+	assert results == [(False, 0)] * len(tile_sets)
+	for tile_set in tile_sets:
+		tile_set.Close()
+
+def test_tile_set_loads_quietly_in_its_own_context(wang_tile_set, tmp_path, capfd):
+	cpft.TileSet(str(wang_tile_set)).Close()
+	assert capfd.readouterr().out == ''
+
+	context = cpft.RunContext(verbose = False)
+	tile_set = cpft.GetTileSet(str(tmp_path / 'missing'), context = context)
+	assert tile_set.tile_map == {}
+	assert context.err_occurred
+	assert not cpft.GetContext().err_occurred
+
+@pytest.mark.parametrize('speed_mode', [cpft.NORMAL, cpft.FAST, cpft.NO_COMPARE, cpft.BACKTRACK])
+def test_reroll_leaves_black_ring_alone(wang_tile_set, speed_mode):
+	tile_set = cpft.TileSet(str(wang_tile_set), add_im = False)
+	tile_grid = tile_set.Generate(size = (8, 6), seed = 1, return_grid = True)
+	tile_grid[1][2] = []
+	before = [list(row) for row in tile_grid]
+	image = cpft.CreatePictureFromTileGrid(tile_grid, tile_set.tile_map, 8, 6)
+
+	context = cpft.RunContext(verbose = False)
+	assert tile_set.Reroll(tile_grid, (3, 2, 4, 3), image = image, speed_mode = speed_mode, seed = 2, context = context) == (3, 2, 4, 3)
+	assert not context.err_occurred
+	assert all(tile_grid[i][j] != [] for i in range(2, 5) for j in range(3, 7))
+	assert all(tile_grid[i][j] == before[i][j] for i in range(6) for j in range(8) if not (2 <= i < 5 and 3 <= j < 7))
+	if speed_mode != cpft.NO_COMPARE:
+		assert CountMismatches(tile_grid, tile_set.tile_map) == 0
+	assert image.tobytes() == cpft.CreatePictureFromTileGrid(tile_grid, tile_set.tile_map, 8, 6).tobytes()
+	tile_set.Close()
+
+def test_reroll_logs_positions_in_the_frame(wang_tile_set, capsys):
+	#The region may only hold a tile with red edges, which doesn't fit against the gray edges around it
+	combos = list(itertools.product([GRAY, RED], repeat = 4))
+	(gray, red) = [combos.index((color,)*4) for color in [GRAY, RED]]
+	WriteYaml(wang_tile_set, 'reroll.yaml', {1:['tile' + str(gray) + '.png'], 2:['tile' + str(red) + '.png']},
+		[[2 if (i, j) == (2, 3) else 1 for j in range(6)] for i in range(5)])
+	tile_set = cpft.TileSet(str(wang_tile_set), add_im = False)
+	gray_id = next(k for (k, tile) in tile_set.tile_map.items() if os.path.basename(tile.filename) == 'tile' + str(gray) + '.png')
+	tile_grid = [[gray_id]*6 for i in range(5)]
+
+	context = cpft.RunContext(verbose = False)
+	tile_set.Reroll(tile_grid, (3, 2, 1, 1), grid = 'reroll.yaml', speed_mode = cpft.FAST, context = context)
+	assert context.err_occurred
+	assert capsys.readouterr().out.count('position (3,2)') == 1
+	assert tile_grid[2][3] == []
+	assert CountMismatches(tile_grid, tile_set.tile_map) == 0
+	tile_set.Close()
+
+@pytest.mark.parametrize('speed_mode', [cpft.NORMAL, cpft.FAST])
+def test_greedy_strips_do_no_worse_than_one_strip(tmp_path, speed_mode):
+	bench.CreateSyntheticTileSet(str(tmp_path), 6, 3, bench.SYM_NONE, 0.2, 81, 1)
+	tile_set = cpft.TileSet(str(tmp_path), add_im = False)
+
+	black = {}
+	for strips in [1, 4]:
+		black[strips] = 0
+		for seed in range(5):
+			tile_grid = tile_set.Generate((10, 20), speed_mode = speed_mode, seed = seed, return_grid = True, strips = strips)
+			assert CountMismatches(tile_grid, tile_set.tile_map) == 0
+			black[strips] += sum(row.count([]) for row in tile_grid)
+	assert black[4] <= black[1]
+	tile_set.Close()
+
+def test_batch_takes_unset_grid_from_command_line_and_reports_unsaved_pictures(wang_tile_set, tmp_path, capsys):
+	WriteYaml(wang_tile_set, 'grid.yaml', {1:['tile' + str(k) + '.png' for k in range(16)]}, [[1]*3]*2)
+	with open(tmp_path / 'manifest.yaml', 'w') as f:
+		f.write('- out: ' + str(tmp_path / 'a.png') + '\n- out: ' + str(tmp_path / 'b.png') + '\n  size: 4,1\n'
+			'- out: ' + str(tmp_path / 'missing' / 'c.png') + '\n')
+	args = cpft.ParseCommandLineArgs(['--path', str(wang_tile_set), '--grid', 'grid.yaml', '--manifest', str(tmp_path / 'manifest.yaml'), '--seed', '1'])
+	tile_set = cpft.TileSet(args.path, args.add_im)
+
+	with cpft.UseContext(cpft.RunContext(verbose = False)) as context:
+		batch = cpft.GetBatchJobs(args)
+		assert [job['grid'] for job in batch] == ['grid.yaml', '', 'grid.yaml']
+		cpft.CreateBatchPictures(batch, tile_set.tile_map, tile_set.bound_index, args, 1)
+	assert context.err_occurred
+	with Image.open(tmp_path / 'a.png') as im:
+		assert im.size == (3*8, 2*8)
+	with Image.open(tmp_path / 'b.png') as im:
+		assert im.size == (4*8, 1*8)
+
+	out = capsys.readouterr().out
+	assert 'Created ' + str(tmp_path / 'a.png') + '\n' in out
+	assert 'Failed to create ' + str(tmp_path / 'missing' / 'c.png') in out
+	assert 'Created ' + str(tmp_path / 'missing' / 'c.png') not in out
+	tile_set.Close()
+
+def test_viable_tile_check_agrees_with_viable_tiles(tmp_path):
+	bench.CreateSyntheticTileSet(str(tmp_path), 6, 3, bench.SYM_NONE, 0.3, 40, 5)
+	tile_set = cpft.TileSet(str(tmp_path), add_im = False)
+	bounds = {dir:sorted(tile_set.bound_index[dir].keys()) for dir in cpft.DIRS}
+	rng = np.random.default_rng(0)
+
+	for trial in range(300):
+		tile_ids = sorted(rng.choice(len(tile_set.tile_map), rng.integers(0, len(tile_set.tile_map) + 1), replace = False).tolist())
+		exp_bound = {dir:[bounds[dir][k] for k in rng.choice(len(bounds[dir]), rng.integers(0, 3), replace = False)] for dir in cpft.DIRS}
+		expected = cpft.GetViableTiles(tile_ids, exp_bound, tile_set.bound_index) != []
+		assert cpft.HasViableTile(set(tile_ids), exp_bound, tile_set.bound_index) == expected
+	tile_set.Close()
+
+def test_low_memory_cache_only_decodes_new_files(wang_tile_set, tmp_path, monkeypatch):
+	opened = []
+	image_open = Image.open
+	def CountingOpen(fp, *args, **kwargs):
+		opened.append(fp)
+		return image_open(fp, *args, **kwargs)
+	monkeypatch.setattr(Image, 'open', CountingOpen)
+	cache_path = str(tmp_path / 'cache.bin')
+	file_count = len(os.listdir(wang_tile_set))
+
+	cpft.TileSet(str(wang_tile_set), cache_path = cache_path, low_memory = True).Close()
+	assert len(opened) == file_count
+
+	opened.clear()
+	WriteTile(wang_tile_set, 'tile0.png', RED, RED, GRAY, GRAY, 99)
+	tile_set = cpft.TileSet(str(wang_tile_set), cache_path = cache_path, low_memory = True)
+	assert len(opened) == 1
+	tile_set.Close()
+
+	#The pixels saved in the cache are those of the files
+	(cached, uncached) = [cpft.TileSet(str(wang_tile_set), cache_path = path) for path in [cache_path, None]]
+	assert [tile.im.tobytes() for tile in cached.tile_map.values()] == [tile.im.tobytes() for tile in uncached.tile_map.values()]
+	cached.Close()
+	uncached.Close()
+
+@pytest.mark.parametrize('profile_memory', [[], ['--profile_memory']])
+def test_profile_report_has_phases_and_counters(wang_tile_set, tmp_path, monkeypatch, profile_memory):
+	out_path = str(tmp_path / 'out.png')
+	argv = ['--path', str(wang_tile_set), '--out', out_path, '--size', '6,6', '--seed', '4', '--profile']
+	monkeypatch.setattr('sys.argv', ['CreatePictureFromTiles.py'] + argv + profile_memory)
+	with cpft.UseContext(cpft.RunContext()) as context:
+		cpft.Main()
+	assert not context.err_occurred
+
+	with open(out_path + '.profile.json') as f:
+		report = json.load(f)
+	for phase in ['load', 'dedup', 'tile_build', 'grid_build', 'process', 'save']:
+		assert report['phases'][phase]['runs'] >= 1
+		assert ('peak_traced_bytes' in report['phases'][phase]) == (profile_memory != [])
+	assert report['counters']['viable_tile_calls'] > 0
+	assert report['counters']['tiles_pasted'] == 36
+	assert report['traced_memory'] == (profile_memory != [])
+
+@pytest.fixture
+def opened_files(monkeypatch):
+	#The tile files which are decoded, so that tests can tell whether tiles came from the cache
+	opened = []
+	image_open = Image.open
+	def CountingOpen(fp, *args, **kwargs):
+		opened.append(fp)
+		return image_open(fp, *args, **kwargs)
+	monkeypatch.setattr(Image, 'open', CountingOpen)
+	return opened
+
+def GetTileSetContents(path, cache_path = None, add_im = True, context = None):
+	tile_set = cpft.TileSet(str(path), add_im, cache_path, context = context)
+	contents = [(tile.filename, tile.transform, tile.im.tobytes(), [tile.edges[dir] for dir in cpft.DIRS])
+		for tile in tile_set.tile_map.values()]
+	tile_set.Close()
+	return contents
+
+def ChangeTileFiles(path, change):
+	if change == 'touch':
+		stat = os.stat(path / 'tile0.png')
+		os.utime(path / 'tile0.png', ns = (stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+	elif change == 'change':
+		WriteTile(path, 'tile0.png', RED, RED, RED, RED, 99)
+	elif change == 'add':
+		WriteTile(path, 'extra9.png', RED, GRAY, RED, GRAY, 99)
+	elif change == 'delete':
+		os.remove(path / 'extra0.png')
+
+@pytest.mark.parametrize(('change', 'decoded'), [('hit', 0), ('touch', 0), ('change', 1), ('add', 1), ('delete', 0)])
+def test_tile_cache_matches_uncached_load(wang_tile_set, tmp_path, opened_files, change, decoded):
+	cache_path = str(tmp_path / 'cache.bin')
+	GetTileSetContents(wang_tile_set, cache_path)
+	ChangeTileFiles(wang_tile_set, change)
+
+	opened_files.clear()
+	cached = GetTileSetContents(wang_tile_set, cache_path)
+	assert len(opened_files) == decoded
+	assert cached == GetTileSetContents(wang_tile_set)
+
+	#The cache saved by the run above holds the change
+	opened_files.clear()
+	assert GetTileSetContents(wang_tile_set, cache_path) == cached
+	assert opened_files == []
+
+def test_tile_cache_made_with_other_add_im_is_ignored(wang_tile_set, tmp_path, opened_files):
+	cache_path = str(tmp_path / 'cache.bin')
+	GetTileSetContents(wang_tile_set, cache_path, add_im = True)
+
+	opened_files.clear()
+	assert GetTileSetContents(wang_tile_set, cache_path, add_im = False) == GetTileSetContents(wang_tile_set, add_im = False)
+	assert len(opened_files) == 2 * len(os.listdir(wang_tile_set))
+
+@pytest.mark.parametrize('cut', [4, 20, -1, None])
+def test_corrupt_tile_cache_is_ignored(wang_tile_set, tmp_path, opened_files, cut):
+	#Cut the cache short inside the magic, the header or the arrays, or overwrite it with garbage
+	cache_path = str(tmp_path / 'cache.bin')
+	GetTileSetContents(wang_tile_set, cache_path)
+	with open(cache_path, 'rb') as f:
+		data = f.read()
+	with open(cache_path, 'wb') as f:
+		f.write(data[:cut] if cut != None else bytes(range(256)) * 4)
+
+	opened_files.clear()
+	context = cpft.RunContext(verbose = False)
+	assert GetTileSetContents(wang_tile_set, cache_path, context = context) == GetTileSetContents(wang_tile_set)
+	assert len(opened_files) == 2 * len(os.listdir(wang_tile_set))
+	assert not context.err_occurred
+
+	#The run above replaced the corrupt cache
+	opened_files.clear()
+	assert GetTileSetContents(wang_tile_set, cache_path) == GetTileSetContents(wang_tile_set)
+	assert len(opened_files) == len(os.listdir(wang_tile_set))
+
+@pytest.mark.parametrize('classes', [False, True])
+def test_benchmark_times_dedup_and_fill_quietly(tmp_path, capfd, classes):
+	tile_path = tmp_path / 'tiles'
+	tile_path.mkdir()
+	bench.CreateSyntheticTileSet(str(tile_path), 6, 2, bench.SYM_MIRROR, 1.0, 16, 3)
+	(timings, tile_count, black_tiles) = bench.RunBenchmark(str(tile_path), str(tmp_path / 'out.png'), True, 8, cpft.NORMAL, classes, 1)
+	assert capfd.readouterr().out == ''
+	assert None not in timings.values()
+	assert black_tiles == 0
+	tile_set = cpft.TileSet(str(tile_path))
+	assert tile_count == len(tile_set.tile_map)
+	tile_set.Close()